@@ -0,0 +1,68 @@
+import argparse
+import os
+import tempfile
+import time
+
+import torch
+
+from export import ExportedTrajREC, example_inputs, export_model
+from models.trajrec import load_trajrec_checkpoint, trajrec_tiny, trajrec_small, trajrec_base, trajrec_large
+from utils import batch_inference
+
+MODELS = {'trajrec_tiny': trajrec_tiny, 'trajrec_small': trajrec_small, 'trajrec_base': trajrec_base,
+          'trajrec_large': trajrec_large}
+
+
+def time_per_batch(run, x, steps, warmup):
+    for _ in range(warmup):
+        run(x)
+    start = time.perf_counter()
+    for _ in range(steps):
+        run(x)
+
+    return (time.perf_counter() - start) / steps
+
+
+def main(args):
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    if args.chkp is not None:
+        model, _ = load_trajrec_checkpoint(args.chkp)
+    else:
+        torch.manual_seed(0)
+        model = MODELS[args.model](input_length=args.input_length, global_input_dim=4, local_input_dim=34,
+                                   prediction_length=args.pred_length).eval()
+
+    runners = {'eager': lambda x: batch_inference(model, x, setting=args.setting)}
+    with tempfile.TemporaryDirectory() as directory:
+        for format, extension in [('torchscript', '.pt'), ('onnx', '.onnx')]:
+            if format in args.formats:
+                path = os.path.join(directory, f'trajrec_{args.setting}{extension}')
+                export_model(model, args.setting, path, format=format)
+                runners[format] = ExportedTrajREC(path, num_threads=args.threads)
+
+        print('batch size | ' + ' | '.join(f'{name} ms' for name in runners))
+        with torch.no_grad():
+            for batch_size in args.batch_sizes:
+                x = [X.numpy() for X in example_inputs(model, batch_size=batch_size)]
+                times = [time_per_batch(run, x, args.steps, args.warmup) * 1000 for run in runners.values()]
+                print(f'{batch_size:10d} | ' + ' | '.join(f'{t:{len(name) + 3}.2f}' for name, t in zip(runners, times)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Compare the per-batch CPU latency of the eager and the exported TrajREC models.')
+
+    parser.add_argument('--chkp', type=str, default=None, help='Checkpoint saved by run.py. By default --model with '
+                                                               'random weights')
+    parser.add_argument('--model', default='trajrec_small', choices=list(MODELS))
+    parser.add_argument('--input_length', default=12, type=int)
+    parser.add_argument('--pred_length', default=6, type=int)
+    parser.add_argument('--setting', default='future', choices=['past', 'present', 'future'])
+    parser.add_argument('--formats', nargs='+', default=['torchscript', 'onnx'], choices=['torchscript', 'onnx'])
+    parser.add_argument('--batch_sizes', nargs='+', type=int, default=[1, 16, 256])
+    parser.add_argument('--steps', default=20, type=int, help='Number of timed batches')
+    parser.add_argument('--warmup', default=3, type=int, help='Number of untimed batches run first')
+    parser.add_argument('--threads', default=None, type=int, help='Number of CPU threads')
+
+    args = parser.parse_args()
+    main(args)
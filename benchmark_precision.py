@@ -0,0 +1,65 @@
+import argparse
+import time
+
+import torch
+from torch import optim
+
+from models.trajrec import trajrec_tiny, trajrec_small, trajrec_base, trajrec_large
+from utils import PRECISIONS, autocast
+
+MODELS = {'trajrec_tiny': trajrec_tiny, 'trajrec_small': trajrec_small, 'trajrec_base': trajrec_base,
+          'trajrec_large': trajrec_large}
+
+
+def benchmark(model, optimizer, x, precision, steps, warmup):
+    device = x[0].device
+    scaler = torch.cuda.amp.GradScaler(enabled=precision == 'fp16' and device.type == 'cuda')
+    step_times = []
+    for step in range(warmup + steps):
+        start = time.perf_counter()
+        with autocast(device, precision):
+            losses, eloss, _, _ = model(x, 'train', compute_loss=True)
+        loss = sum(losses[:-1]) + eloss
+        optimizer.zero_grad()
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        if step >= warmup:
+            step_times.append(time.perf_counter() - start)
+
+    return sum(step_times) / len(step_times), loss.item()
+
+
+def main(args):
+    device = torch.device(args.device)
+    sequence_length = args.input_length + args.pred_length
+    x = [torch.rand(args.batch_size, sequence_length, 4, device=device),
+         torch.rand(args.batch_size, sequence_length, 34, device=device),
+         torch.rand(args.batch_size, sequence_length, 34, device=device)]
+
+    for precision in args.precisions:
+        torch.manual_seed(0)
+        model = MODELS[args.model](input_length=args.input_length, global_input_dim=4, local_input_dim=34,
+                                   prediction_length=args.pred_length).to(device)
+        optimizer = optim.Adam(model.parameters(), lr=1e-4)
+        step_time, loss = benchmark(model, optimizer, x, precision, args.steps, args.warmup)
+        print(f'{precision}: {step_time * 1000:.1f} ms/step (last loss {loss:.4e})')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Compare the training step time of a TrajREC model in every precision.')
+
+    parser.add_argument('--model', default='trajrec_small', choices=list(MODELS))
+    parser.add_argument('--device', type=str, default='cpu', help='Device to run the benchmark on, e.g. cpu or cuda:0')
+    parser.add_argument('--precisions', nargs='+', default=['fp32', 'bf16'], choices=list(PRECISIONS),
+                        help='Precisions to benchmark. fp16 autocast needs a GPU')
+    parser.add_argument('--batch_size', default=256, type=int)
+    parser.add_argument('--input_length', default=12, type=int)
+    parser.add_argument('--pred_length', default=6, type=int)
+    parser.add_argument('--steps', default=10, type=int, help='Number of timed training steps')
+    parser.add_argument('--warmup', default=2, type=int, help='Number of untimed training steps run first')
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,110 @@
+import argparse
+import http.client
+import json
+import socket
+import threading
+import time
+
+import numpy as np
+import torch
+
+from inference_server import create_server, load_service
+from utils import PRECISIONS
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, path):
+        super().__init__('localhost')
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+
+def run_client(connect, payloads, latencies):
+    connection = connect()
+    for payload in payloads:
+        start = time.perf_counter()
+        connection.request('POST', '/windows', body=payload, headers={'Content-Type': 'application/json'})
+        response = connection.getresponse()
+        response.read()
+        if response.status != 200:
+            raise RuntimeError(f'Request failed with status {response.status}')
+        latencies.append(time.perf_counter() - start)
+    connection.close()
+
+
+def benchmark(service, args, window_length, video_resolution):
+    """Latencies of `args.requests` requests from each of `args.clients` concurrent clients, and the wall time."""
+    server = create_server(service, port=0, unix_socket=args.unix_socket)
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    if args.unix_socket is not None:
+        connect = lambda: UnixHTTPConnection(args.unix_socket)
+    else:
+        connect = lambda: http.client.HTTPConnection(*server.server_address[:2])
+
+    rng = np.random.default_rng(0)
+    windows = rng.uniform(0, 1, size=(args.requests, args.windows_per_request, window_length, 34))
+    windows = (windows * np.tile(video_resolution, 17)).round(1)
+    payloads = [json.dumps({'windows': request_windows.tolist()}) for request_windows in windows]
+
+    # warm up the model and the connections
+    run_client(connect, payloads[:2], [])
+    service.batcher.batch_sizes.clear()
+
+    latencies = [[] for _ in range(args.clients)]
+    clients = [threading.Thread(target=run_client, args=(connect, payloads, client_latencies))
+               for client_latencies in latencies]
+    start = time.perf_counter()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    wall_time = time.perf_counter() - start
+
+    server.shutdown()
+    server.server_close()
+
+    return np.concatenate(latencies), wall_time
+
+
+def main(args):
+    video_resolution = np.array([int(dim) for dim in args.video_resolution.split('x')], dtype=np.float32)
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    print(f'{args.clients} clients x {args.requests} requests of {args.windows_per_request} windows, '
+          f'max latency {args.max_latency_ms} ms')
+    print('max batch | mean batch | windows/s | p50 ms | p99 ms')
+    for max_batch_size in args.max_batch_sizes:
+        service = load_service(args.chkp, video_resolution, max_batch_size=max_batch_size,
+                               max_latency=args.max_latency_ms / 1000, precision=args.precision)
+        latencies, wall_time = benchmark(service, args, service.window_length, video_resolution)
+        service.batcher.close()
+
+        latencies = latencies * 1000
+        throughput = len(latencies) * args.windows_per_request / wall_time
+        print(f'{max_batch_size:9d} | {np.mean(service.batcher.batch_sizes):10.1f} | {throughput:9.0f} | '
+              f'{np.percentile(latencies, 50):6.1f} | {np.percentile(latencies, 99):6.1f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Measure the latency and throughput of the inference server on localhost for '
+                                     'several maximum batch sizes.')
+
+    parser.add_argument('--chkp', type=str, required=True, help='Checkpoint saved by run.py')
+    parser.add_argument('--max_batch_sizes', nargs='+', type=int, default=[1, 8, 32, 128])
+    parser.add_argument('--max_latency_ms', default=5., type=float)
+    parser.add_argument('--clients', default=16, type=int, help='Number of concurrent clients')
+    parser.add_argument('--requests', default=50, type=int, help='Number of requests sent by every client')
+    parser.add_argument('--windows_per_request', default=1, type=int)
+    parser.add_argument('--unix_socket', type=str, default=None, help='Serve on this Unix socket instead of TCP')
+    parser.add_argument('--video_resolution', default='856x480', type=str)
+    parser.add_argument('--precision', default='fp32', choices=list(PRECISIONS))
+    parser.add_argument('--threads', default=None, type=int, help='Number of torch CPU threads of the server')
+
+    args = parser.parse_args()
+    main(args)
@@ -1,20 +1,12 @@
-from copy import deepcopy
 import os,sys
 
 import joblib
 import numpy as np
+import torch
+from torch.utils.data import Dataset
 
-from trajectories import load_trajectories, remove_short_trajectories, input_trajectories_missing_steps, extract_global_features, scale_trajectories, change_coordinate_system
-from utils import memory
-
-
-def aggregate_autoencoder_data(trajectories):
-    """Put all trajectories into a single big numpy array."""
-    X = []
-    for trajectory in trajectories.values():
-        X.append(trajectory.coordinates)
-
-    return np.vstack(X)
+from trajectories import load_trajectories, remove_short_trajectories, input_trajectories_missing_steps, scale_trajectories, concatenate_coordinates, extract_coordinate_features, change_coordinate_system
+from utils import array_cache
 
 
 def split_into_train_and_test(trajectories, train_ratio=0.8, seed=42):
@@ -53,253 +45,215 @@ def split_into_train_and_test(trajectories, train_ratio=0.8, seed=42):
     return trajectories_train, trajectories_val
 
 
-def aggregate_rnn_autoencoder_data(trajectories, input_length, input_gap=0, pred_length=0):
+def sliding_windows(array, window_length, input_gap=0):
     """
-    Split each skeleton trajectory into smaller (overlapping) fixed size segments and put them all in a single large
-    numpy array.
+    All the (overlapping) windows of `window_length` steps along the first axis of `array`, as a (N, L, ...) strided
+    view that shares the memory of `array`. With `input_gap` > 0 every window spans
+    `window_length + input_gap * (window_length - 1)` steps of which only every `input_gap + 1`-th is kept.
+    The view is read-only; copy it (or stack several of them) to get an array of its own.
     """
-    Xs, Xs_pred = [], []
-    for trajectory in trajectories.values():
-        X, X_pred = _aggregate_rnn_autoencoder_data(trajectory.coordinates, input_length, input_gap, pred_length)
-        Xs.append(X)
-        if X_pred is not None:
-            Xs_pred.append(X_pred)
-
-    Xs = np.vstack(Xs)
-    if not Xs_pred:
-        Xs_pred = None
-    else:
-        Xs_pred = np.vstack(Xs_pred)
+    total_window_length = window_length + input_gap * (window_length - 1)
+    windows = np.lib.stride_tricks.sliding_window_view(array, total_window_length, axis=0)
+    # sliding_window_view puts the window axis last: (N, ..., L) -> (N, L, ...)
+    windows = np.moveaxis(windows, -1, 1)
 
-    return Xs, Xs_pred
+    return windows[:, ::input_gap + 1]
 
 
 def _aggregate_rnn_autoencoder_data(coordinates, input_length, input_gap=0, pred_length=0):
     """
-    Split a skeleton trajectory into an array smaller (overlapping) fixed size segments.
+    Split a skeleton trajectory into an array smaller (overlapping) fixed size segments. The segments are views into
+    `coordinates`.
     """
-    input_trajectories, future_trajectories = [], None
+    future_trajectories = None
     total_input_seq_len = input_length + input_gap * (input_length - 1)
-    step = input_gap + 1
     if pred_length > 0:
-        future_trajectories = []
-        stop = len(coordinates) - pred_length - total_input_seq_len + 1
-        for start_index in range(0, stop):
-            stop_index = start_index + total_input_seq_len
-            input_trajectories.append(coordinates[start_index:stop_index:step, :])
-            future_trajectories.append(coordinates[stop_index:(stop_index + pred_length), :])
-        input_trajectories = np.stack(input_trajectories, axis=0)
-        future_trajectories = np.stack(future_trajectories, axis=0)
+        input_trajectories = sliding_windows(coordinates[:len(coordinates) - pred_length], input_length, input_gap)
+        future_trajectories = sliding_windows(coordinates[total_input_seq_len:], pred_length)
     else:
-        stop = len(coordinates) - total_input_seq_len + 1
-        for start_index in range(0, stop):
-            stop_index = start_index + total_input_seq_len
-            input_trajectories.append(coordinates[start_index:stop_index:step, :])
-        input_trajectories = np.stack(input_trajectories, axis=0)
+        input_trajectories = sliding_windows(coordinates, input_length, input_gap)
 
     return input_trajectories, future_trajectories
 
 
-@memory.cache
-def create_train_val_v2(trajectories_path, video_resolution, input_length, pred_length, reconstruct_original_data=True,
-                        input_missing_steps=False, global_normalisation_strategy='zero_one',
-                        local_normalisation_strategy='zero_one', out_normalisation_strategy='zero_one', elsec_data=False):
-    video_resolution = [float(measurement) for measurement in video_resolution.split('x')]
-    video_resolution = np.array(video_resolution, dtype=np.float32)
-    # print('hello')
-    trajectories = load_trajectories(trajectories_path, elsec_data=elsec_data)
-    #print('\nLoaded %d trajectories.' % len(trajectories))
-
+def aggregate_rnn_autoencoder_features(X, offsets, input_length, input_gap=0, pred_length=0):
+    """
+    Split the per-frame features of many trajectories, stacked back to back with the offset of every trajectory in `X`,
+    into smaller (overlapping) fixed size segments and put them all in a single large numpy array.
+    """
+    segments = [_aggregate_rnn_autoencoder_data(X[start:stop], input_length, input_gap, pred_length)
+                for start, stop in zip(offsets[:-1], offsets[1:])]
+    Xs = np.vstack([X_segments for X_segments, _ in segments])
+    Xs_pred = np.vstack([X_pred for _, X_pred in segments]) if pred_length > 0 else None
 
-    trajectories = remove_short_trajectories(trajectories, input_length=input_length,
-                                             input_gap=0, pred_length=pred_length)
-    #print('\nRemoved short trajectories. Number of trajectories left: %d.' % len(trajectories))
+    return Xs, Xs_pred
 
-    trajectories_train, trajectories_val = split_into_train_and_test(trajectories, train_ratio=0.98, seed=42)
 
-    if input_missing_steps:
-        trajectories_train = input_trajectories_missing_steps(trajectories_train)
-    #    print('\nInputted missing steps of trajectories.')
-
-    # TODO: General function to extract features
-    # X_..._train, X_..._val, y_..._train, y_..._val, ..._scaler = general_function()
-
-    # Global
-    global_trajectories_train = extract_global_features(deepcopy(trajectories_train), video_resolution=video_resolution)
-    global_trajectories_val = extract_global_features(deepcopy(trajectories_val), video_resolution=video_resolution)
-
-    global_trajectories_train = change_coordinate_system(global_trajectories_train, video_resolution=video_resolution,
-                                                         coordinate_system='global', invert=False)
-    global_trajectories_val = change_coordinate_system(global_trajectories_val, video_resolution=video_resolution,
-                                                       coordinate_system='global', invert=False)
-    #print('\nChanged global trajectories\'s coordinate system to global.')
-
-    _, global_scaler = scale_trajectories(aggregate_autoencoder_data(global_trajectories_train),
-                                          strategy=global_normalisation_strategy)
-
-    X_global_train, y_global_train = aggregate_rnn_autoencoder_data(global_trajectories_train,
-                                                                    input_length=input_length,
-                                                                    input_gap=0, pred_length=pred_length)
-    X_global_val, y_global_val = aggregate_rnn_autoencoder_data(global_trajectories_val, input_length=input_length,
-                                                                input_gap=0, pred_length=pred_length)
-
-    X_global_train, _ = scale_trajectories(X_global_train, scaler=global_scaler, strategy=global_normalisation_strategy)
-    X_global_val, _ = scale_trajectories(X_global_val, scaler=global_scaler, strategy=global_normalisation_strategy)
-    if y_global_train is not None and y_global_val is not None:
-        y_global_train, _ = scale_trajectories(y_global_train, scaler=global_scaler,
-                                               strategy=global_normalisation_strategy)
-        y_global_val, _ = scale_trajectories(y_global_val, scaler=global_scaler, strategy=global_normalisation_strategy)
-    #print('\nNormalised global trajectories using the %s normalisation strategy.' % global_normalisation_strategy)
-
-    # Local
-    local_trajectories_train = deepcopy(trajectories_train) if reconstruct_original_data else trajectories_train
-    local_trajectories_val = deepcopy(trajectories_val) if reconstruct_original_data else trajectories_val
-
-    local_trajectories_train = change_coordinate_system(local_trajectories_train, video_resolution=video_resolution,
-                                                        coordinate_system='bounding_box_centre', invert=False)
-    local_trajectories_val = change_coordinate_system(local_trajectories_val, video_resolution=video_resolution,
-                                                      coordinate_system='bounding_box_centre', invert=False)
-    #print('\nChanged local trajectories\'s coordinate system to bounding_box_centre.')
-
-    _, local_scaler = scale_trajectories(aggregate_autoencoder_data(local_trajectories_train),
-                                         strategy=local_normalisation_strategy)
-
-    X_local_train, y_local_train = aggregate_rnn_autoencoder_data(local_trajectories_train, input_length=input_length,
-                                                                  input_gap=0, pred_length=pred_length)
-    X_local_val, y_local_val = aggregate_rnn_autoencoder_data(local_trajectories_val, input_length=input_length,
-                                                              input_gap=0, pred_length=pred_length)
-
-    X_local_train, _ = scale_trajectories(X_local_train, scaler=local_scaler, strategy=local_normalisation_strategy)
-    X_local_val, _ = scale_trajectories(X_local_val, scaler=local_scaler, strategy=local_normalisation_strategy)
-    if y_local_train is not None and y_local_val is not None:
-        y_local_train, _ = scale_trajectories(y_local_train, scaler=local_scaler, strategy=local_normalisation_strategy)
-        y_local_val, _ = scale_trajectories(y_local_val, scaler=local_scaler, strategy=local_normalisation_strategy)
-    #print('\nNormalised local trajectories using the %s normalisation strategy.' % local_normalisation_strategy)
-
-    # (Optional) Reconstruct the original data
-    if reconstruct_original_data:
-        #print('\nReconstruction/Prediction target is the original data.')
-        out_trajectories_train = trajectories_train
-        out_trajectories_val = trajectories_val
-
-        out_trajectories_train = change_coordinate_system(out_trajectories_train, video_resolution=video_resolution,
-                                                          coordinate_system='global', invert=False)
-        out_trajectories_val = change_coordinate_system(out_trajectories_val, video_resolution=video_resolution,
-                                                        coordinate_system='global', invert=False)
-        #print('\nChanged target trajectories\'s coordinate system to global.')
-
-        _, out_scaler = scale_trajectories(aggregate_autoencoder_data(out_trajectories_train),
-                                           strategy=out_normalisation_strategy)
-
-        X_out_train, y_out_train = aggregate_rnn_autoencoder_data(out_trajectories_train, input_length=input_length,
-                                                                  input_gap=0, pred_length=pred_length)
-        X_out_val, y_out_val = aggregate_rnn_autoencoder_data(out_trajectories_val, input_length=input_length,
-                                                              input_gap=0, pred_length=pred_length)
-
-        X_out_train, _ = scale_trajectories(X_out_train, scaler=out_scaler, strategy=out_normalisation_strategy)
-        X_out_val, _ = scale_trajectories(X_out_val, scaler=out_scaler, strategy=out_normalisation_strategy)
-        if y_out_train is not None and y_out_val is not None:
-            y_out_train, _ = scale_trajectories(y_out_train, scaler=out_scaler, strategy=out_normalisation_strategy)
-            y_out_val, _ = scale_trajectories(y_out_val, scaler=out_scaler, strategy=out_normalisation_strategy)
-        #print('\nNormalised target trajectories using the %s normalisation strategy.' % out_normalisation_strategy)
-    else:
-        out_scaler = None
+@array_cache('train_val_v2', version=2, ignore=['load_workers'], fingerprint=['trajectories_path'])
+def create_train_val_v2(trajectories_path, video_resolution, input_length, pred_length, reconstruct_original_data=True,
+                        input_missing_steps=False, global_normalisation_strategy='zero_one',
+                        local_normalisation_strategy='zero_one', out_normalisation_strategy='zero_one', elsec_data=False,
+                        load_workers=0):
+    (features_train, offsets_train), (features_val, offsets_val), trajectories_train, trajectories_val, scalers = \
+        _load_train_val_features(trajectories_path, video_resolution, input_length, pred_length,
+                                 reconstruct_original_data=reconstruct_original_data,
+                                 input_missing_steps=input_missing_steps,
+                                 global_normalisation_strategy=global_normalisation_strategy,
+                                 local_normalisation_strategy=local_normalisation_strategy,
+                                 out_normalisation_strategy=out_normalisation_strategy, elsec_data=elsec_data,
+                                 load_workers=load_workers)
+    global_scaler, local_scaler, out_scaler = scalers
+
+    # The trajectories are returned in the coordinate system of the last features derived from them, as they used to
+    # be transformed in place: global, or relative to the bounding box centre without the out features.
+    coordinate_system = 'global' if reconstruct_original_data else 'bounding_box_centre'
+    resolution = np.array([float(measurement) for measurement in video_resolution.split('x')], dtype=np.float32)
+    for trajectories in (trajectories_train, trajectories_val):
+        change_coordinate_system(trajectories, video_resolution=resolution, coordinate_system=coordinate_system)
+
+    # Segments of the global, local and (optionally) out features, in that order.
+    X_train, y_train, X_val, y_val = [], [], [], []
+    for X_train_features, X_val_features in zip(features_train, features_val):
+        X, y = aggregate_rnn_autoencoder_features(X_train_features, offsets_train, input_length=input_length,
+                                                  input_gap=0, pred_length=pred_length)
+        X_train.append(X)
+        y_train.append(y)
+        X, y = aggregate_rnn_autoencoder_features(X_val_features, offsets_val, input_length=input_length,
+                                                  input_gap=0, pred_length=pred_length)
+        X_val.append(X)
+        y_val.append(y)
 
-    if y_global_train is not None:
-        if reconstruct_original_data:
-            # X_global_train, X_local_train, X_out_train, y_global_train, y_local_train, y_out_train = \
-            #     shuffle(X_global_train, X_local_train, X_out_train,
-            #             y_global_train, y_local_train, y_out_train, random_state=42)
-            X_train = [X_global_train, X_local_train, X_out_train]
-            y_train = [y_global_train, y_local_train, y_out_train]
-            val_data = ([X_global_val, X_local_val, X_out_val], [y_global_val, y_local_val, y_out_val])
-        else:
-            # X_global_train, X_local_train, y_global_train, y_local_train = \
-            #     shuffle(X_global_train, X_local_train, y_global_train, y_local_train, random_state=42)
-            X_train = [X_global_train, X_local_train]
-            y_train = [y_global_train, y_local_train]
-            val_data = ([X_global_val, X_local_val], [y_global_val, y_local_val])
+    if pred_length > 0:
+        val_data = (X_val, y_val)
     else:
-        if reconstruct_original_data:
-            # X_global_train, X_local_train, X_out_train = \
-            #     shuffle(X_global_train, X_local_train, X_out_train, random_state=42)
-            X_train = [X_global_train, X_local_train, X_out_train]
-            y_train = None
-            val_data = ([X_global_val, X_local_val, X_out_val],)
-        else:
-            # X_global_train, X_local_train = shuffle(X_global_train, X_local_train, random_state=42)
-            X_train = [X_global_train, X_local_train]
-            y_train = None
-            val_data = ([X_global_val, X_local_val],)
+        y_train = None
+        val_data = (X_val,)
 
     return X_train, y_train, val_data, trajectories_train, trajectories_val, global_scaler, local_scaler, out_scaler
 
 
-def _construct_output_data_alt(multiple_outputs, reconstruction_length, reconstruct_reverse, prediction_length, X_out,
-                               y_out=None, X_global=None, y_global=None, X_local=None, y_local=None):
+def extract_trajectory_features(trajectories, video_resolution, reconstruct_original_data=True):
     """
-    Put (some of) X_global, X_local, ..., y_out into a list, optionally reversing the X arrays in time (for the RNN
-    reconstruction).
+    Per-frame input features of all trajectories, stacked in the order of `trajectories`: the global bounding box
+    features, the local coordinates (relative to the bounding box centre) and, optionally, the global coordinates of
+    the skeleton. Returns the list of feature arrays and the offset of every trajectory in them. The trajectories
+    themselves are not modified.
     """
-    y = []
+    coordinates, split_indices = concatenate_coordinates(trajectories)
+    offsets = np.concatenate(([0], split_indices, [len(coordinates)])).astype(np.int64)
+    features = extract_coordinate_features(coordinates, video_resolution=video_resolution,
+                                           reconstruct_original_data=reconstruct_original_data)
 
-    if multiple_outputs:
-        if reconstruct_reverse:
-            y.append(X_global[:, (reconstruction_length - 1)::-1, :])
-            y.append(X_local[:, (reconstruction_length - 1)::-1, :])
-            y.append(X_out[:, (reconstruction_length - 1)::-1, :])
-        else:
-            y.append(X_global[:, :reconstruction_length, :])
-            y.append(X_local[:, :reconstruction_length, :])
-            y.append(X_out[:, :reconstruction_length, :])
-
-        if prediction_length > 0:
-            y.append(y_global)
-            y.append(y_local)
-            y.append(y_out)
-    else:
-        if reconstruct_reverse:
-            y.append(X_out[:, (reconstruction_length - 1)::-1, :])
-        else:
-            y.append(X_out[:, :reconstruction_length, :])
+    return features, offsets
 
-        if prediction_length > 0:
-            y.append(y_out)
 
-    return y
+def _load_train_val_features(trajectories_path, video_resolution, input_length, pred_length,
+                             reconstruct_original_data=True, input_missing_steps=False,
+                             global_normalisation_strategy='zero_one', local_normalisation_strategy='zero_one',
+                             out_normalisation_strategy='zero_one', elsec_data=False, load_workers=0):
+    video_resolution = [float(measurement) for measurement in video_resolution.split('x')]
+    video_resolution = np.array(video_resolution, dtype=np.float32)
+    trajectories = load_trajectories(trajectories_path, elsec_data=elsec_data, num_workers=load_workers)
+    trajectories = remove_short_trajectories(trajectories, input_length=input_length,
+                                             input_gap=0, pred_length=pred_length)
 
+    trajectories_train, trajectories_val = split_into_train_and_test(trajectories, train_ratio=0.98, seed=42)
+    if input_missing_steps:
+        trajectories_train = input_trajectories_missing_steps(trajectories_train)
+
+    features_train, offsets_train = extract_trajectory_features(trajectories_train, video_resolution,
+                                                                reconstruct_original_data=reconstruct_original_data)
+    features_val, offsets_val = extract_trajectory_features(trajectories_val, video_resolution,
+                                                            reconstruct_original_data=reconstruct_original_data)
 
-def aggregate_rnn_ae_evaluation_data(trajectories, input_length):
-    trajectories_ids, frames, X = [], [], []
-    for trajectory in trajectories.values():
-        traj_ids, traj_frames, traj_X = _aggregate_rnn_ae_evaluation_data(trajectory, input_length)
-        trajectories_ids.append(traj_ids)
-        frames.append(traj_frames)
-        X.append(traj_X)
+    strategies = [global_normalisation_strategy, local_normalisation_strategy, out_normalisation_strategy]
+    scalers = [None, None, None]
+    for idx, (X_train, X_val) in enumerate(zip(features_train, features_val)):
+        features_train[idx], scalers[idx] = scale_trajectories(X_train, strategy=strategies[idx])
+        features_val[idx], _ = scale_trajectories(X_val, scaler=scalers[idx], strategy=strategies[idx])
 
-    trajectories_ids, frames, X = np.vstack(trajectories_ids), np.vstack(frames), np.vstack(X)
+    return (features_train, offsets_train), (features_val, offsets_val), trajectories_train, trajectories_val, scalers
+
+
+@array_cache('train_val_features', ignore=['load_workers'], fingerprint=['trajectories_path'])
+def create_train_val_features(trajectories_path, video_resolution, input_length, pred_length,
+                              reconstruct_original_data=True, input_missing_steps=False,
+                              global_normalisation_strategy='zero_one', local_normalisation_strategy='zero_one',
+                              out_normalisation_strategy='zero_one', elsec_data=False, load_workers=0):
+    """
+    Same data as `create_train_val_v2`, but kept per frame instead of split into segments: the normalised global,
+    local and (optionally) out features of the train and validation trajectories with their offsets, for
+    `WindowedTrajectoryDataset` to cut the segments from on the fly.
+    """
+    train_data, val_data, _, _, scalers = \
+        _load_train_val_features(trajectories_path, video_resolution, input_length, pred_length,
+                                 reconstruct_original_data=reconstruct_original_data,
+                                 input_missing_steps=input_missing_steps,
+                                 global_normalisation_strategy=global_normalisation_strategy,
+                                 local_normalisation_strategy=local_normalisation_strategy,
+                                 out_normalisation_strategy=out_normalisation_strategy, elsec_data=elsec_data,
+                                 load_workers=load_workers)
+    global_scaler, local_scaler, out_scaler = scalers
 
-    return trajectories_ids, frames, X
+    return train_data, val_data, global_scaler, local_scaler, out_scaler
 
 
-def _aggregate_rnn_ae_evaluation_data(trajectory, input_length):
-    traj_frames, traj_X = [], []
-    coordinates = trajectory.coordinates
-    frames = trajectory.frames
+class WindowedTrajectoryDataset(Dataset):
+    """
+    Segments of `input_length + pred_length` steps cut on the fly from per-frame trajectory features. Every feature
+    array is stored once and the dataset only keeps the (trajectory, start) pair of each segment, instead of a copy of
+    every overlapping segment. Examples are laid out like the tensors of `create_train_val_datasets` used to be: the
+    inputs of each feature, the (reversed) reconstruction targets and, if `pred_length` > 0, the future targets.
+    """
 
-    total_input_seq_len = input_length
-    stop = len(coordinates) - total_input_seq_len + 1
-    for start_index in range(stop):
-        stop_index = start_index + total_input_seq_len
-        traj_X.append(coordinates[start_index:stop_index, :])
-        traj_frames.append(frames[start_index:stop_index])
+    def __init__(self, features, offsets, input_length, pred_length=0, rec_length=None, reconstruct_reverse=True):
+        self.features = [torch.from_numpy(np.ascontiguousarray(X, dtype=np.float32)) for X in features]
+        self.input_length = input_length
+        self.pred_length = pred_length
+        self.rec_length = input_length if rec_length is None else rec_length
+        self.reconstruct_reverse = reconstruct_reverse
+
+        window_length = input_length + pred_length
+        num_windows = np.maximum(np.diff(offsets) - window_length + 1, 0)
+        trajectory_indices = np.repeat(np.arange(len(num_windows)), num_windows)
+        starts = np.arange(num_windows.sum()) - np.repeat(np.cumsum(num_windows) - num_windows, num_windows)
+        self.index = np.stack((trajectory_indices, starts), axis=1)
+        self._window_starts = torch.from_numpy(np.asarray(offsets)[trajectory_indices] + starts)
+        self._window_steps = torch.arange(window_length)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, index):
+        """
+        The example at `index` or, for a list of indices (e.g. from a `BatchSampler` in a `DataLoader` with
+        `batch_size=None`), the batch of their examples, cut all at once.
+        """
+        if np.ndim(index) == 0:
+            return tuple(tensor[0] for tensor in self._get_batch([index]))
+        return self._get_batch(index)
+
+    def _get_batch(self, indices):
+        steps = self._window_starts[torch.as_tensor(indices)].unsqueeze(1) + self._window_steps
+        windows = [X[steps] for X in self.features]
+
+        inputs = [window[:, :self.input_length] for window in windows]
+        if self.reconstruct_reverse:
+            reconstructions = [X[:, :self.rec_length].flip(1) for X in inputs]
+        else:
+            reconstructions = [X[:, :self.rec_length] for X in inputs]
+        futures = [window[:, self.input_length:] for window in windows] if self.pred_length > 0 else []
 
-    traj_frames, traj_X = np.stack(traj_frames, axis=0), np.stack(traj_X, axis=0)
+        return tuple(inputs + reconstructions + futures)
 
-    trajectory_id = trajectory.trajectory_id
-    traj_ids = np.full(traj_frames.shape, fill_value=trajectory_id)
 
-    return traj_ids, traj_frames, traj_X
+def aggregate_rnn_ae_evaluation_features(X, offsets, input_length):
+    """
+    All the evaluation windows of `input_length` frames of the per-frame features of many trajectories, stacked back
+    to back with the offset of every trajectory in `X`.
+    """
+    return np.concatenate([sliding_windows(X[start:stop], input_length)
+                           for start, stop in zip(offsets[:-1], offsets[1:])])
 
 
 def load_scalers(pretrained_model_path):
@@ -333,37 +287,50 @@ def load_evaluation_data(global_scaler,
                          out_norm='zero_one', 
                          rec_data=True,
                          sort=False,
-                         elsec_data=False):
-    trajectories = load_trajectories(trajectories_path, sort, elsec_data=elsec_data)
+                         elsec_data=False,
+                         load_workers=0,
+                         use_cache=True):
+    """
+    The trajectory of every window element is given as an int32 code, the index of its `<video id>_<skeleton id>`
+    string in the returned `trajectory_names` table. The video of every trajectory is given in turn by an int32 code,
+    its index in the `video_names` table returned last.
+
+    With `use_cache`, the prepared arrays are cached on disk under a key derived from the contents of
+    `trajectories_path` (file names, sizes and modification times), all the preprocessing arguments and the scalers,
+    and memory mapped from there whenever the same data is requested again.
+    """
+    load = _load_evaluation_data if use_cache else _load_evaluation_data.func
+    return load(global_scaler, local_scaler, out_scaler, trajectories_path, inp_len, inp_gap, pred_len, res, bb_norm,
+                joint_norm, out_norm, rec_data, sort, elsec_data, load_workers)
+
+
+@array_cache('evaluation_data', version=3, ignore=['load_workers'], fingerprint=['trajectories_path'])
+def _load_evaluation_data(global_scaler, local_scaler, out_scaler, trajectories_path, inp_len, inp_gap, pred_len, res,
+                          bb_norm, joint_norm, out_norm, rec_data, sort, elsec_data, load_workers):
+    trajectories = load_trajectories(trajectories_path, sort, elsec_data=elsec_data, num_workers=load_workers)
 
     trajectories = remove_short_trajectories(trajectories, input_length=inp_len,
                                              input_gap=inp_gap, pred_length=pred_len)
 
-    global_trajectories = extract_global_features(deepcopy(trajectories), video_resolution=res)
-    global_trajectories = change_coordinate_system(global_trajectories, video_resolution=res,
-                                                   coordinate_system='global', invert=False)
-    
-    trajectories_ids, frames, X_global = aggregate_rnn_ae_evaluation_data(global_trajectories,
-                                                                          input_length=inp_len+pred_len)
-    X_global, _ = scale_trajectories(X_global, scaler=global_scaler, strategy=bb_norm)
-
-    local_trajectories = deepcopy(trajectories)
-    local_trajectories = change_coordinate_system(local_trajectories, video_resolution=res,
-                                                  coordinate_system='bounding_box_centre', invert=False)
-    _, _, X_local = aggregate_rnn_ae_evaluation_data(local_trajectories, input_length=inp_len+pred_len)
-    X_local, _ = scale_trajectories(X_local, scaler=local_scaler, strategy=joint_norm)
-
-    original_trajectories = deepcopy(trajectories)
-    _, _, X_original = aggregate_rnn_ae_evaluation_data(original_trajectories, input_length=inp_len+pred_len)
-
-    if rec_data:
-        out_trajectories = trajectories
-        out_trajectories = change_coordinate_system(out_trajectories, video_resolution=res,
-                                                    coordinate_system='global', invert=False)
-        _, _, X_out = aggregate_rnn_ae_evaluation_data(out_trajectories, input_length=inp_len+pred_len)
-        X_out, _ = scale_trajectories(X_out, scaler=out_scaler, strategy=out_norm)
-    else:
-        X_out = None
-
-    
-    return trajectories_ids, frames, X_global, X_local, X_out, global_scaler, local_scaler, out_scaler
+    # All the features are derived from the raw coordinates at once, leaving the trajectories untouched.
+    features, offsets = extract_trajectory_features(trajectories, video_resolution=res, reconstruct_original_data=rec_data)
+    scalers, strategies = [global_scaler, local_scaler, out_scaler], [bb_norm, joint_norm, out_norm]
+    window_length = inp_len + pred_len
+    for idx, X in enumerate(features):
+        X, _ = scale_trajectories(X, scaler=scalers[idx], strategy=strategies[idx])
+        features[idx] = aggregate_rnn_ae_evaluation_features(X, offsets, input_length=window_length)
+    X_global, X_local = features[:2]
+    X_out = features[2] if rec_data else None
+
+    frames = aggregate_rnn_ae_evaluation_features(np.concatenate([trajectory.frames for trajectory in trajectories.values()]),
+                                                  offsets, input_length=window_length)
+    num_windows = np.diff(offsets) - window_length + 1
+    trajectory_names = np.array([trajectory.trajectory_id for trajectory in trajectories.values()])
+    trajectories_ids = np.arange(len(trajectory_names), dtype=np.int32)
+    trajectories_ids = np.repeat(np.repeat(trajectories_ids, num_windows)[:, np.newaxis], window_length, axis=1)
+    video_names, trajectory_videos = np.unique([trajectory_id.split('_')[0] for trajectory_id in trajectory_names],
+                                               return_inverse=True)
+    trajectory_videos = trajectory_videos.astype(np.int32)
+
+    return trajectories_ids, frames, X_global, X_local, X_out, global_scaler, local_scaler, out_scaler, \
+        trajectory_names, trajectory_videos, video_names
@@ -0,0 +1,81 @@
+import argparse
+import io
+import os
+import time
+
+import numpy as np
+import torch
+
+from models.trajrec import load_trajrec_checkpoint
+from quantization import QUANTIZATIONS, load_calibration_data, quantize_model
+from run import load_test_data, prediction_auc_score
+
+SETTINGS = ['past', 'present', 'future']
+
+
+def model_size(model):
+    """Size in bytes of the serialised weights of `model`."""
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+@torch.no_grad()
+def main(args):
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    model, checkpoint = load_trajrec_checkpoint(args.chkp)
+    scalers = (checkpoint['bb_scaler'], checkpoint['joint_scaler'], checkpoint['out_scaler'])
+    res = np.array([int(dim) for dim in args.video_resolution.split('x')], dtype=np.float32)
+    camera_ids = sorted(os.listdir(os.path.join(args.testdata, 'trajectories')))
+    data_test = load_test_data(args.testdata, camera_ids, scalers, input_length=model.input_length,
+                               pred_length=model.prediction_length, res=res)
+    is_avenue = 'avenue' in args.testdata.lower()
+
+    calibration_data = None
+    if 'static' in args.quantizations:
+        if args.trajectories is None:
+            raise ValueError('Static quantisation is calibrated on the training windows of --trajectories.')
+        calibration_data = load_calibration_data(args.trajectories, args.video_resolution, model.input_length,
+                                                 model.prediction_length, num_windows=args.calibration_windows)
+
+    results = {}
+    for quantization in args.quantizations:
+        quantized_model = quantize_model(model, quantization, calibration_data=calibration_data)
+        start = time.perf_counter()
+        scores = prediction_auc_score(quantized_model, data_test, batch_size=args.batch_size, setting=SETTINGS,
+                                      is_avenue=is_avenue)
+        results[quantization] = ({setting: scores[setting][0] for setting in SETTINGS}, time.perf_counter() - start,
+                                 model_size(quantized_model))
+
+    aucs, reference_time, reference_size = results[args.quantizations[0]]
+    print(f'Relative to {args.quantizations[0]}:')
+    print('quantization | ' + ' | '.join(f'{setting} AUC (delta)' for setting in SETTINGS) + ' | time s (speedup) | '
+          'size MB (reduction)')
+    for quantization, (quantization_aucs, scoring_time, size) in results.items():
+        print(f'{quantization:12s} | '
+              + ' | '.join(f'{quantization_aucs[setting]:.4f} ({quantization_aucs[setting] - aucs[setting]:+.4f})'
+                           for setting in SETTINGS)
+              + f' | {scoring_time:.1f} ({reference_time / scoring_time:.2f}x) | '
+                f'{size / 1e6:.1f} ({reference_size / size:.2f}x)')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Compare the test AUC, the CPU scoring time and the size of a TrajREC checkpoint '
+                                     'in fp32 and quantised to int8.')
+
+    parser.add_argument('--chkp', type=str, required=True, help='Checkpoint saved by run.py')
+    parser.add_argument('--testdata', type=str, required=True,
+                        help='Directory with the trajectories and frame_level_masks of the test cameras')
+    parser.add_argument('--trajectories', type=str, default=None,
+                        help='Training trajectories to calibrate the static quantisation on')
+    parser.add_argument('--video_resolution', default='856x480', type=str)
+    parser.add_argument('--quantizations', nargs='+', default=QUANTIZATIONS, choices=QUANTIZATIONS,
+                        help='The first one is the reference of the deltas')
+    parser.add_argument('--calibration_windows', default=2048, type=int,
+                        help='Number of training windows to calibrate the static quantisation on')
+    parser.add_argument('--batch_size', default=256, type=int)
+    parser.add_argument('--threads', default=None, type=int, help='Number of torch CPU threads')
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,121 @@
+import argparse
+import copy
+import os
+
+import numpy as np
+import torch
+from torch import nn
+
+from models.trajrec import load_trajrec_checkpoint
+
+INPUT_NAMES = ['x_global', 'x_local', 'x_out']
+OUTPUT_NAMES = ['pred_global', 'pred_local', 'pred_out', 'target_global', 'target_local', 'target_out']
+FORMATS = {'torchscript': '.pt', 'onnx': '.onnx'}
+
+
+class TrajRECSetting(nn.Module):
+    """
+    A TrajREC model fixed to one evaluation setting, for export: the global, local and out features are separate
+    inputs, the mask of the setting is baked into the graph and the outputs are the predictions and the targets of
+    `TrajREC.forward(x, setting, foreval=True)`, flattened into one tuple.
+    """
+
+    def __init__(self, model, setting):
+        super().__init__()
+        self.model = model
+        self.setting = setting
+
+    def forward(self, x_global, x_local, x_out):
+        pred, target = self.model([x_global, x_local, x_out], self.setting, foreval=True)
+        return (*pred, *target)
+
+
+def example_inputs(model, batch_size=2):
+    sequence_length = model.input_length + model.prediction_length
+    local_input_dim = model.decoder_merge_coords.out_features
+    return (torch.rand(batch_size, sequence_length, model.global_input_dim),
+            torch.rand(batch_size, sequence_length, local_input_dim),
+            torch.rand(batch_size, sequence_length, local_input_dim))
+
+
+@torch.no_grad()
+def export_model(model, setting, path, format='torchscript'):
+    """
+    Export `model` in `setting` to `path`, as a traced TorchScript module or as an ONNX graph, both with a dynamic
+    batch size.
+    """
+    module = TrajRECSetting(copy.deepcopy(model).cpu(), setting).eval()
+    inputs = example_inputs(model)
+    if format == 'torchscript':
+        torch.jit.save(torch.jit.trace(module, inputs), path)
+    elif format == 'onnx':
+        torch.onnx.export(module, inputs, path, input_names=INPUT_NAMES, output_names=OUTPUT_NAMES,
+                          dynamic_axes={name: {0: 'batch'} for name in INPUT_NAMES + OUTPUT_NAMES})
+    else:
+        raise ValueError(f'Unknown export format {format}. Please select either torchscript or onnx.')
+
+
+class ExportedTrajREC:
+    """
+    An exported TrajREC model run on CPU, with TorchScript or onnxruntime according to the extension of `path`. Calling
+    it with the list of the global, local and out features of a batch returns `(pred, target)` as lists of numpy arrays,
+    like `batch_inference`.
+    """
+
+    def __init__(self, path, num_threads=None):
+        self.format = 'onnx' if path.endswith('.onnx') else 'torchscript'
+        if self.format == 'onnx':
+            import onnxruntime
+
+            options = onnxruntime.SessionOptions()
+            if num_threads is not None:
+                options.intra_op_num_threads = num_threads
+            self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        else:
+            self.module = torch.jit.load(path, map_location='cpu').eval()
+
+    def __call__(self, x):
+        if self.format == 'onnx':
+            inputs = {name: np.asarray(X, dtype=np.float32) for name, X in zip(INPUT_NAMES, x)}
+            outputs = self.session.run(OUTPUT_NAMES, inputs)
+        else:
+            with torch.no_grad():
+                outputs = [output.numpy() for output in self.module(*(torch.as_tensor(X, dtype=torch.float32) for X in x))]
+
+        return list(outputs[:3]), list(outputs[3:])
+
+
+def save_scalers(checkpoint, path):
+    """
+    The min-max scalers of a checkpoint as plain arrays, so that the features can be normalised without sklearn: a
+    zero feature is first replaced by `{name}_data_min`, then scaled as `X * {name}_scale + {name}_min`.
+    """
+    arrays = {}
+    for name in ['bb_scaler', 'joint_scaler', 'out_scaler']:
+        scaler = checkpoint[name]
+        arrays.update({f'{name}_data_min': scaler.data_min_, f'{name}_scale': scaler.scale_, f'{name}_min': scaler.min_})
+    np.savez(path, **arrays)
+
+
+def main(args):
+    model, checkpoint = load_trajrec_checkpoint(args.chkp)
+    os.makedirs(args.output_dir, exist_ok=True)
+    name = os.path.splitext(os.path.basename(args.chkp))[0]
+    for setting in args.settings:
+        path = os.path.join(args.output_dir, f'{name}_{setting}{FORMATS[args.format]}')
+        export_model(model, setting, path, format=args.format)
+        print(f'Exported the {setting} setting to {path}')
+    save_scalers(checkpoint, os.path.join(args.output_dir, f'{name}_scalers.npz'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Export a TrajREC checkpoint to TorchScript or ONNX, one graph per setting.')
+
+    parser.add_argument('--chkp', type=str, required=True, help='Checkpoint saved by run.py')
+    parser.add_argument('--format', default='torchscript', choices=list(FORMATS))
+    parser.add_argument('--settings', nargs='+', default=['past', 'present', 'future'],
+                        choices=['past', 'present', 'future'])
+    parser.add_argument('--output_dir', type=str, default='exported')
+
+    args = parser.parse_args()
+    main(args)
@@ -79,6 +79,10 @@ parser.add_argument('--write_bounding_boxes', action='store_true')
 parser.add_argument('--lambda1', default=3.0, type=float)
 parser.add_argument('--lambda2', default=3.0, type=float)
 parser.add_argument('--lambda3', default=5.0, type=float)
+parser.add_argument('--load_workers', default=0, type=int,
+                    help='Number of processes parsing the trajectory csv files in parallel. 0 parses them serially.')
+parser.add_argument('--eval_cache', default=True, type=lambda x: (str(x).lower() == 'true'),
+                    help='Bool if to cache the preprocessed test data of every camera on disk and reuse it.')
 
 
 
@@ -141,20 +145,22 @@ def main():
     for camera_id in sorted(os.listdir(all_trajectories_path)):
         trajectories_path = os.path.join(all_trajectories_path, camera_id)
         anomaly_masks = load_anomaly_masks(os.path.join(all_anomaly_masks, camera_id))
-        trajectories_ids, frames, X_global, X_local, X_out, _, _, _ = \
+        trajectories_ids, frames, X_global, X_local, X_out, _, _, _, trajectory_names, _, _ = \
             load_evaluation_data(bb_scaler, joint_scaler, out_scaler, trajectories_path, input_length, 0, pred_length,
-                                 video_resolution, 'zero_one', 'zero_one', 'zero_one', True, sort)
-        data.append((anomaly_masks, trajectories_ids, frames, X_global, X_local, X_out))
+                                 video_resolution, 'zero_one', 'zero_one', 'zero_one', True, sort,
+                                 load_workers=args['load_workers'], use_cache=args['eval_cache'])
+        data.append((anomaly_masks, trajectories_ids, frames, X_global, X_local, X_out, trajectory_names))
     
     settings = ['past','present','future']
     
-    for setting in settings:
-        for anomaly_masks, trajectories_ids, frames, X_global, X_local, X_out in data:
-            with torch.no_grad():
-                predicted_frames = frames[:, :pred_length] + input_length
-                predicted_ids = trajectories_ids[:, :pred_length]
-                
-                out, _ = batch_inference(model, [X_global, X_local, X_out], batch_size=1024, setting=setting)
+    # Every camera goes through the model once, under all of the settings together.
+    for anomaly_masks, trajectories_ids, frames, X_global, X_local, X_out, trajectory_names in data:
+        with torch.no_grad():
+            predicted_frames = frames[:, :pred_length] + input_length
+            predicted_ids = trajectories_ids[:, :pred_length]
+            
+            results = batch_inference(model, [X_global, X_local, X_out], batch_size=1024, setting=settings)
+            for setting, (out, _) in zip(settings, results):
                 _, _, predicted_out = out
                 
                 if setting=='past':
@@ -170,7 +176,8 @@ def main():
                 prediction_ids, prediction_frames, predicted_y_traj = \
                 summarise_reconstruction(predicted_y_traj, predicted_frames, predicted_ids)
                 
-                write_reconstructed_trajectories('reconstructed', predicted_y_traj, prediction_ids, prediction_frames,
+                write_reconstructed_trajectories('reconstructed', predicted_y_traj, trajectory_names[prediction_ids],
+                                                prediction_frames,
                                                 trajectory_type=f'predicted_skeleton_{setting}')
         
         
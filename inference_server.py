@@ -0,0 +1,280 @@
+import argparse
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import queue
+import socketserver
+import threading
+import time
+
+import numpy as np
+import torch
+
+from models.trajrec import load_trajrec_checkpoint
+from quantization import quantize_model_dynamic
+from streaming import TrackFeatureState, extract_scaled_features
+from trajectories import compute_rnn_ae_reconstruction_errors
+from utils import PRECISIONS, autocast
+
+SETTINGS = ['past', 'present', 'future']
+
+
+class MicroBatcher:
+    """
+    Scores the windows submitted by concurrent requests in shared batches. A batch is started by the first waiting
+    request and takes in the requests that arrive within `max_latency` seconds of it, up to `max_batch_size` windows
+    (a single larger request is scored on its own). Every batch is evaluated under all the `settings` in one pass of
+    the model, and the score of a window in a setting is its mean error over the positions masked in that setting.
+    """
+
+    def __init__(self, model, settings=SETTINGS, max_batch_size=256, max_latency=0.005, precision='fp32'):
+        self.model = model.eval()
+        self.device = next(model.parameters()).device
+        self.settings = list(settings)
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.precision = precision
+        self.scored_positions = {setting: np.flatnonzero(getattr(model.masking, f'mask_{setting}').reshape(-1).cpu().numpy() == 0)
+                                 for setting in self.settings}
+        self.batch_sizes = []
+
+        # request that did not fit in the previous batch, and starts the next one
+        self.pending = None
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, features):
+        """
+        Queue the windows given by their stacked (N, T, dim) global, local and out features, returning a `Future` of
+        the dict mapping every setting to the (N,) scores of the windows.
+        """
+        future = Future()
+        self.queue.put((features, future))
+        return future
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def _next_batch(self):
+        request, self.pending = self.pending or self.queue.get(), None
+        if request is None:
+            return None
+        requests = [request]
+        batch_size = len(request[0][0])
+        deadline = time.perf_counter() + self.max_latency
+        while batch_size < self.max_batch_size:
+            try:
+                request = self.queue.get(timeout=max(0., deadline - time.perf_counter()))
+            except queue.Empty:
+                break
+            if request is None:
+                # score what was collected, then stop
+                self.queue.put(None)
+                break
+            if batch_size + len(request[0][0]) > self.max_batch_size:
+                self.pending = request
+                break
+            requests.append(request)
+            batch_size += len(request[0][0])
+
+        return requests
+
+    def _run(self):
+        while (requests := self._next_batch()) is not None:
+            features = [np.concatenate(X) for X in zip(*(features for features, _ in requests))]
+            self.batch_sizes.append(len(features[0]))
+            try:
+                scores = self.score(features)
+            except Exception as error:
+                for _, future in requests:
+                    future.set_exception(error)
+                continue
+
+            start = 0
+            for request_features, future in requests:
+                end = start + len(request_features[0])
+                future.set_result({setting: setting_scores[start:end] for setting, setting_scores in scores.items()})
+                start = end
+
+    @torch.no_grad()
+    def score(self, features):
+        x = [torch.from_numpy(X).to(self.device) for X in features]
+        with autocast(self.device, self.precision):
+            results = self.model(x, self.settings, foreval=True)
+        scores = {}
+        for setting, (pred, target) in zip(self.settings, results):
+            errors = compute_rnn_ae_reconstruction_errors(target[-1].float().cpu().numpy(),
+                                                          pred[-1].float().cpu().numpy(), 'mse')
+            scores[setting] = errors[:, self.scored_positions[setting]].mean(axis=1)
+
+        return scores
+
+
+class TrajRECService:
+    """
+    The state of the server: the batcher, the scalers of the checkpoint and, for frame payloads, the latest features of
+    the tracks of every stream.
+    """
+
+    def __init__(self, batcher, scalers, video_resolution, window_length, max_idle_frames=None):
+        self.batcher = batcher
+        self.scalers = scalers
+        self.video_resolution = np.asarray(video_resolution, dtype=np.float32)
+        self.window_length = window_length
+        self.max_idle_frames = window_length if max_idle_frames is None else max_idle_frames
+        self.streams = {}
+        self.lock = threading.Lock()
+
+    def score_windows(self, windows):
+        """Scores of a (N, T, 34) array of skeleton windows in image coordinates, per setting."""
+        windows = np.asarray(windows, dtype=np.float32)
+        if windows.ndim != 3 or windows.shape[1] != self.window_length:
+            raise ValueError(f'Expected windows of shape (N, {self.window_length}, 34), got {windows.shape}')
+        num_windows = len(windows)
+        features = extract_scaled_features(windows.reshape(-1, windows.shape[-1]), self.video_resolution, self.scalers)
+        features = [X.reshape(num_windows, self.window_length, -1) for X in features]
+        scores = self.batcher.submit(features).result()
+
+        return {setting: setting_scores.tolist() for setting, setting_scores in scores.items()}
+
+    def score_frame(self, stream, frame, detections):
+        """
+        Push the detections of `frame` of `stream`, a dict mapping track ids to their (34,) keypoints, and return the
+        scores per setting of the windows of the tracks whose buffers are full, keyed by track id.
+        """
+        with self.lock:
+            tracks = self.streams.setdefault(stream, {})
+            if detections:
+                coordinates = np.asarray(list(detections.values()), dtype=np.float32)
+                features = extract_scaled_features(coordinates, self.video_resolution, self.scalers)
+                for index, track_id in enumerate(detections):
+                    if track_id not in tracks:
+                        tracks[track_id] = TrackFeatureState(self.window_length, [X.shape[-1] for X in features])
+                    tracks[track_id].push(frame, [X[index] for X in features])
+            self.streams[stream] = tracks = {track_id: track for track_id, track in tracks.items()
+                                             if frame - track.last_frame <= self.max_idle_frames}
+            ready = [track_id for track_id in detections if tracks[track_id].is_full()]
+            if not ready:
+                return {}
+            windows = [np.stack(X) for X in zip(*(tracks[track_id].window()[0] for track_id in ready))]
+
+        scores = self.batcher.submit(windows).result()
+        return {track_id: {setting: float(setting_scores[index]) for setting, setting_scores in scores.items()}
+                for index, track_id in enumerate(ready)}
+
+
+class TrajRECRequestHandler(BaseHTTPRequestHandler):
+    """
+    POST /windows with {"windows": [N x T x 34 keypoints]} returns {"scores": {setting: [N scores]}}.
+    POST /frame with {"stream": id, "frame": n, "detections": {track id: [34 keypoints]}} returns
+    {"scores": {track id: {setting: score}}} for the tracks with a full window.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        try:
+            payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            if self.path == '/windows':
+                scores = self.server.service.score_windows(payload['windows'])
+            elif self.path == '/frame':
+                scores = self.server.service.score_frame(payload['stream'], int(payload['frame']),
+                                                         payload['detections'])
+            else:
+                self._reply(404, {'error': f'Unknown path {self.path}'})
+                return
+        except (KeyError, TypeError, ValueError) as error:
+            self._reply(400, {'error': str(error)})
+            return
+        except Exception as error:
+            # e.g. the model failing on a batch: reply instead of dropping the connection
+            self._reply(500, {'error': str(error)})
+            return
+        self._reply(200, {'scores': scores})
+
+    def _reply(self, status, body):
+        body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return str(self.client_address[0]) if self.client_address else self.server.server_address
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def create_server(service, host='127.0.0.1', port=8000, unix_socket=None, verbose=False):
+    """An HTTP server for `service`, on `host:port` or, if given, on the Unix socket at `unix_socket`."""
+    if unix_socket is not None:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        server = ThreadingUnixHTTPServer(unix_socket, TrajRECRequestHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), TrajRECRequestHandler)
+        server.daemon_threads = True
+    server.service = service
+    server.verbose = verbose
+
+    return server
+
+
+def load_service(path, video_resolution, device='cpu', max_batch_size=256, max_latency=0.005, precision='fp32',
+                 quantize=False):
+    """With `quantize`, the linear layers of the model run in int8 (see `quantize_model_dynamic`), on CPU."""
+    model, checkpoint = load_trajrec_checkpoint(path, map_location=device)
+    model = quantize_model_dynamic(model) if quantize else model.to(device)
+    batcher = MicroBatcher(model, max_batch_size=max_batch_size, max_latency=max_latency,
+                           precision=precision)
+    scalers = [checkpoint['bb_scaler'], checkpoint['joint_scaler'], checkpoint['out_scaler']]
+
+    return TrajRECService(batcher, scalers, video_resolution, model.input_length + model.prediction_length)
+
+
+def main(args):
+    video_resolution = [int(dim) for dim in args.video_resolution.split('x')]
+    device = torch.device(args.gpu_id if args.gpu_id != -1 else 'cpu')
+    service = load_service(args.chkp, video_resolution, device=device, max_batch_size=args.max_batch_size,
+                           max_latency=args.max_latency_ms / 1000, precision=args.precision, quantize=args.quantize)
+    server = create_server(service, host=args.host, port=args.port, unix_socket=args.unix_socket,
+                           verbose=args.verbose)
+    print(f'Serving {args.chkp} on {args.unix_socket or f"http://{args.host}:{args.port}"}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.batcher.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Serve the anomaly scores of a TrajREC checkpoint over HTTP, batching the '
+                                     'windows of concurrent requests.')
+
+    parser.add_argument('--chkp', type=str, required=True, help='Checkpoint saved by run.py')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--unix_socket', type=str, default=None, help='Serve on this Unix socket instead of TCP')
+    parser.add_argument('--video_resolution', default='856x480', type=str, help='Resolution of the videos, as WxH')
+    parser.add_argument('--max_batch_size', default=256, type=int, help='Maximum number of windows per forward pass')
+    parser.add_argument('--max_latency_ms', default=5., type=float,
+                        help='How long a batch waits for more requests after its first one')
+    parser.add_argument('--gpu_id', default=-1, type=int, help='Which GPU to use. -1 for cpu')
+    parser.add_argument('--precision', default='fp32', choices=list(PRECISIONS))
+    parser.add_argument('--quantize', action='store_true', help='Run the linear layers in int8, on CPU')
+    parser.add_argument('--verbose', action='store_true', help='Log every request')
+
+    args = parser.parse_args()
+    main(args)
@@ -2,47 +2,54 @@ import torch
 from torch import nn
 
 class TokenMasking(nn.Module):
-    def __init__(self, 
-                 input_length, 
+    def __init__(self,
+                 input_length,
                  prediction_length):
         super().__init__()
         self.input_length = input_length
         self.prediction_length = prediction_length
-        self.sequence_length = self.input_length + self.prediction_length 
-              
-        
+        self.sequence_length = self.input_length + self.prediction_length
+
+        # The masks of every setting are built once and follow the module across devices. They are not persistent so
+        # that checkpoints keep loading as before.
+        half = self.input_length//2
+        self.register_buffer('mask_future', self._mask(range(self.input_length)), persistent=False)
+        self.register_buffer('mask_past', self._mask(range(self.prediction_length,self.sequence_length)), persistent=False)
+        self.register_buffer('mask_present', self._mask(list(range(half)) + list(range(half+self.prediction_length,self.sequence_length))),
+                             persistent=False)
+
+    def _mask(self, visible):
+        mask = torch.zeros((1,self.sequence_length,1))
+        mask[:, list(visible)] = 1.
+        return mask
+
     def forward(self, x, setting, shuffle=True):
-        batch_mask = torch.ones((x[0].shape[0],self.sequence_length,1), requires_grad=False)
-        device = x[0].device
-        if setting=='future' or 'train' in setting:
-            mask_future = torch.nn.functional.one_hot(torch.tensor([i for i in range(self.input_length)], requires_grad=False),self.sequence_length).sum(0).unsqueeze(0).unsqueeze(-1)
-            if not 'train' in setting:
-                mask = mask_future
-                batch_mask = batch_mask.to(device) * mask.to(device)
-        if setting=='past' or 'train' in setting:
-            mask_past = torch.nn.functional.one_hot(torch.tensor([i for i in range(self.prediction_length,self.sequence_length)], requires_grad=False),self.sequence_length).sum(0).unsqueeze(0).unsqueeze(-1)
-            if not 'train' in setting:
-                mask = mask_past
-                batch_mask = batch_mask.to(device) * mask.to(device)
-        if setting=='present' or 'train' in setting:
-            half = self.input_length//2
-            mask_traj_right = torch.nn.functional.one_hot(torch.tensor([i for i in range(half)], requires_grad=False),self.sequence_length).sum(0).unsqueeze(0).unsqueeze(-1)
-            mask_traj_left = torch.nn.functional.one_hot(torch.tensor([i for i in range(half+self.prediction_length,self.sequence_length)], requires_grad=False),self.sequence_length).sum(0).unsqueeze(0).unsqueeze(-1)
-            mask_present = mask_traj_right + mask_traj_left
-            if not 'train' in setting:
-                mask = mask_present
-                batch_mask = batch_mask.to(device) * mask.to(device)
-        if setting=='train':
-            x = x
-            i1 = int(batch_mask.shape[0]*0.33)
-            i2 = int(batch_mask.shape[0]*0.66)
-            batch_mask[:i1] *= mask_future
-            batch_mask[i1:i2] *= mask_past
-            batch_mask[i2:] *= mask_present
+        batch_size = x[0].shape[0]
+        if setting=='future':
+            batch_mask = self.mask_future.expand(batch_size,-1,-1)
+        elif setting=='past':
+            batch_mask = self.mask_past.expand(batch_size,-1,-1)
+        elif setting=='present':
+            batch_mask = self.mask_present.expand(batch_size,-1,-1)
+        elif setting=='train':
+            # A third of the batch gets each of the future, past and present masks, in random order.
+            i1 = int(batch_size*0.33)
+            i2 = int(batch_size*0.66)
+            positions = torch.arange(batch_size, device=self.mask_future.device)
             if shuffle:
-                indices = torch.randperm(x[0].shape[0])
-                batch_mask = batch_mask[indices]
-            batch_mask = batch_mask.to(device)
+                positions = torch.randperm(batch_size, device=self.mask_future.device)
+            assignment = (positions >= i1).long() + (positions >= i2).long()
+            batch_mask = torch.cat((self.mask_future, self.mask_past, self.mask_present))[assignment]
+        else:
+            batch_mask = torch.ones((batch_size,self.sequence_length,1), device=self.mask_future.device)
         target = [x[0] * abs(1.-batch_mask), x[1] * abs(1.-batch_mask), x[2] * abs(1.-batch_mask)]
-            
-        return batch_mask, target
\ No newline at end of file
+
+        return batch_mask, target
+
+    def stack(self, x, settings):
+        """
+        Masks and targets for `len(settings)` copies of the batch `x` concatenated along the batch axis, the i-th copy
+        being masked according to `settings[i]`.
+        """
+        masks, targets = zip(*(self(x, setting) for setting in settings))
+        return torch.cat(masks), [torch.cat(target) for target in zip(*targets)]
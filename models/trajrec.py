@@ -92,6 +92,10 @@ class TrajREC(nn.Module):
         
         self.lambdas = lambdas # local, global, out
         
+        # temporal distance |i - j| between every pair of positions, weighting the pairwise embedding loss
+        positions = torch.arange(self.sequence_length, dtype=torch.float32)
+        self.register_buffer('temporal_weights', abs(positions.unsqueeze(0) - positions.unsqueeze(1)), persistent=False)
+        
 
     def initialize_weights(self):
         # initialization
@@ -121,8 +125,12 @@ class TrajREC(nn.Module):
 
     def forward_encoder(self, x, setting='future', no_masking=False):
         
-        batch_size = x[0].shape[0]
         mask, target = self.masking(x,setting)
+        x = self.encode(x, mask, no_masking=no_masking)
+        
+        return x, mask, target
+
+    def encode(self, x, mask, no_masking=False):
         x = x[:2]
         
         # embed patches
@@ -138,7 +146,7 @@ class TrajREC(nn.Module):
             x = blk(x)
         x = self.norm(x)
         
-        return x, mask, target
+        return x
 
     def forward_decoder(self, x, mask, foreval=False):
         # embed tokens
@@ -170,6 +178,8 @@ class TrajREC(nn.Module):
             return pred_global, pred_local, pred_out, pred_out*abs(1.-mask)
     
     def loss_fn(self,y_pred, y_true, lambda_x, temp_weights=None, nosum=False):        
+        # reduced precision outputs (under autocast) are compared in fp32, so that the sums cannot overflow
+        y_pred, y_true = y_pred.float(), y_true.float()
         mask = (y_true != 0.0).to(torch.int8)
         a = (y_pred - y_true) ** 2
         if temp_weights is not None:
@@ -179,20 +189,56 @@ class TrajREC(nn.Module):
         loss = (a * mask).sum() / (mask.sum() + 1e-8)
         return loss * lambda_x
 
+    def temporal_loss(self, latent, gt_latent, lambda_x):
+        """
+        Same as summing `loss_fn(y_true=gt_latent.unsqueeze(1), y_pred=latent.unsqueeze(2), temp_weights=sw,
+        nosum=True)` over its second axis, with sw the temporal distances between positions, but without building the
+        B x T x T x D tensor: the weighted sum of squared differences is expanded into (T x T) @ (B x T x D) products.
+        """
+        # the expanded square cancels out large terms, hence fp32 even under autocast
+        latent, gt_latent = latent.float(), gt_latent.float()
+        sw = self.temporal_weights.t()
+        mask = (gt_latent != 0.0).to(torch.int8)
+        a = torch.matmul(sw, latent ** 2) - 2 * gt_latent * torch.matmul(sw, latent) + gt_latent ** 2 * sw.sum(1, keepdim=True)
+        return a * mask * lambda_x
+
+    def forward_settings(self, x, settings, foreval=True):
+        """
+        Evaluate the batch under every setting of `settings` with a single encoder/decoder pass, by stacking one copy
+        of the batch per setting along the batch axis. Returns the `(pred, target)` pair of each setting, as given by
+        `forward(x, setting, foreval=foreval)`.
+        """
+        mask, target = self.masking.stack(x, settings)
+        x = [d.repeat(len(settings), 1, 1) for d in x]
+        latent = self.encode(x, mask)
+        pred = self.forward_decoder(latent, mask, foreval=foreval)
+        
+        preds = zip(*(p.chunk(len(settings)) for p in pred))
+        targets = zip(*(t.chunk(len(settings)) for t in target))
+        return [(list(p), list(t)) for p, t in zip(preds, targets)]
+
     def forward(self, x, setting, compute_loss=False, beta=1e-3, gamma=1e-1, foreval=False):
+        """
+        `setting` may also be a sequence of settings, evaluated together by `forward_settings`, without losses.
+        """
+        if not isinstance(setting, str):
+            if compute_loss:
+                raise ValueError('The losses can only be computed under a single setting.')
+            return self.forward_settings(x, setting, foreval=foreval)
         latent, mask, target = self.forward_encoder(x, setting)
         pred = self.forward_decoder(latent, mask, foreval=foreval)  # ([N, T, G=4], [N, T, L=34], [N, T, C=34], (occluded only) [N, T, C=34])
         if compute_loss:
             dlosses = [self.loss_fn(y_true=t, y_pred=p, lambda_x=l) for p,t,l in zip(pred, x, self.lambdas)]
             dlosses.append(self.loss_fn(y_true=target[-1], y_pred=pred[-1], lambda_x=1.))
+            # A separate pass on purpose: stacking the unmasked inputs on the batch axis of the masked pass gives the
+            # same losses, but runs the encoder backward over them too and is slower per step.
             with torch.set_grad_enabled(False):
                 gt_latent, _, _ = self.forward_encoder(x, setting, no_masking=True)            
-            latent = (latent * mask) + 1e-9
-            gt_latent = (gt_latent * mask) + 1e-9 
+            # in fp32, as the 1e-9 offset would vanish in reduced precision
+            latent = (latent.float() * mask) + 1e-9
+            gt_latent = (gt_latent.float() * mask) + 1e-9 
             pl = F.relu(self.loss_fn(y_true=gt_latent, y_pred=latent, lambda_x=1.0, nosum=True))
-            sw = abs(torch.tensor(range(1,gt_latent.shape[1]+1), requires_grad=False).unsqueeze(0) - torch.tensor(range(1,gt_latent.shape[1]+1), requires_grad=False).unsqueeze(1)).unsqueeze(0).unsqueeze(-1)
-            sl = self.loss_fn(y_true=gt_latent.unsqueeze(1), y_pred=latent.unsqueeze(2), lambda_x=beta, temp_weights=sw.to(dtype=gt_latent.dtype), nosum=True)
-            sl = F.relu(torch.sum(sl,1,keepdim=False))
+            sl = F.relu(self.temporal_loss(latent, gt_latent, lambda_x=beta))
             hl = F.relu(self.loss_fn(y_true=torch.flip(gt_latent,[0]), y_pred=latent, lambda_x=1.0, nosum=True))
             eloss = torch.sum(F.relu(torch.amax(pl-sl-hl+gamma,dim=(1,2)))*1e-3)
             return dlosses, eloss, pred, target
@@ -244,6 +290,29 @@ def trajrec_huge(**kwargs):
     return model
 
 
+TRAJREC_MODELS = {'trajrec_tiny': trajrec_tiny, 'trajrec_small': trajrec_small, 'trajrec_small1': trajrec_small1,
+                  'trajrec_base': trajrec_base, 'trajrec_large': trajrec_large, 'trajrec_huge': trajrec_huge}
+
+
+def load_trajrec_checkpoint(path, map_location='cpu'):
+    """
+    Rebuild the model of a checkpoint saved by run.py, returning it (in eval mode) with the checkpoint itself, which
+    also holds the scalers. The architecture of `trajrec_custom` models is not recorded, so they cannot be rebuilt.
+    """
+    checkpoint = torch.load(path, map_location=map_location, weights_only=False)
+    if checkpoint['model_name'] not in TRAJREC_MODELS:
+        raise ValueError(f"Cannot rebuild a {checkpoint['model_name']} model from its checkpoint")
+    state_dict = checkpoint['model']
+    total_dim = state_dict['input_embed.weight'].shape[1]
+    local_input_dim = state_dict['decoder_merge_coords.weight'].shape[0]
+    model = TRAJREC_MODELS[checkpoint['model_name']](input_length=checkpoint['input_length'],
+                                                     prediction_length=checkpoint['prediction_length'],
+                                                     global_input_dim=total_dim - local_input_dim,
+                                                     local_input_dim=local_input_dim)
+    model.load_state_dict(state_dict)
+
+    return model.eval(), checkpoint
+
 
 
 if __name__=='__main__':
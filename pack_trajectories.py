@@ -0,0 +1,22 @@
+import argparse
+
+from trajectories import pack_trajectories
+
+
+def main(args):
+    store_path = pack_trajectories(args.datadir, store_path=args.outputdir, elsec_data=args.elsec_data)
+    print(f'Packed trajectories of {args.datadir} into {store_path}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Pack a directory of csv skeleton trajectories into a single binary store.')
+
+    parser.add_argument('--datadir', type=str, required=True,
+                        help='The directory containing the csv skeleton trajectories')
+    parser.add_argument('--outputdir', type=str, default=None,
+                        help='Where to write the store. By default it is written inside the data directory, '
+                             'where it is used automatically when loading the trajectories')
+    parser.add_argument('--elsec_data', action='store_true', help='The csv files are in the ELSEC format')
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,94 @@
+import copy
+
+import numpy as np
+import torch
+from torch import nn
+from torch.ao.quantization import DeQuantStub, QuantStub, convert, get_default_qconfig, prepare, quantize_dynamic
+
+from dataloader import create_train_val_v2
+from utils import batch_inference
+
+QUANTIZATIONS = ['fp32', 'dynamic', 'static']
+
+
+class StaticQuantLinear(nn.Module):
+    """A linear layer with int8 inputs, weights and outputs, between quantisation stubs for the eager static API."""
+
+    def __init__(self, linear):
+        super().__init__()
+        self.quant = QuantStub()
+        self.linear = linear
+        self.dequant = DeQuantStub()
+
+    def forward(self, x):
+        return self.dequant(self.linear(self.quant(x)))
+
+
+def quantize_model_dynamic(model):
+    """
+    A CPU copy of `model` with the weights of all its linear layers in int8. The activations are quantised on the fly,
+    batch by batch, so no calibration is needed.
+    """
+    model = copy.deepcopy(model).cpu().eval()
+    return quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+def _wrap_linear_layers(module):
+    for name, child in module.named_children():
+        if isinstance(child, nn.Linear):
+            setattr(module, name, StaticQuantLinear(child))
+        else:
+            _wrap_linear_layers(child)
+
+
+@torch.no_grad()
+def quantize_model_static(model, calibration_data, batch_size=256, backend='x86'):
+    """
+    A CPU copy of `model` with its linear layers in int8, the scales of their inputs being fixed beforehand by
+    observing `calibration_data`, the list of the global, local and out features of training windows, under the three
+    evaluation settings. The rest of the model (layer norms, attention, masking) stays in fp32.
+
+    The weights are packed for the quantised engine `backend`, which is selected while quantising and then reset to
+    the previous engine. The model should be run with `torch.backends.quantized.engine` set to `backend`, which is
+    the default engine on x86 CPUs.
+    """
+    model = copy.deepcopy(model).cpu().eval()
+    _wrap_linear_layers(model)
+    qconfig = get_default_qconfig(backend)
+    for module in model.modules():
+        if isinstance(module, StaticQuantLinear):
+            module.qconfig = qconfig
+
+    previous_engine = torch.backends.quantized.engine
+    torch.backends.quantized.engine = backend
+    try:
+        prepare(model, inplace=True)
+        batch_inference(model, calibration_data, batch_size=batch_size, setting=['past', 'present', 'future'])
+        convert(model, inplace=True)
+    finally:
+        torch.backends.quantized.engine = previous_engine
+
+    return model
+
+
+def load_calibration_data(trajectories_path, video_resolution, input_length, pred_length, num_windows=2048, seed=0):
+    """A random sample of `num_windows` training windows, as from `create_train_val_v2`, to calibrate on."""
+    X_train, y_train = create_train_val_v2(trajectories_path, video_resolution, input_length, pred_length)[:2]
+    windows = [np.concatenate((X, y), axis=1).astype(np.float32) for X, y in zip(X_train, y_train)]
+    rng = np.random.default_rng(seed)
+    sample = rng.choice(len(windows[0]), size=min(num_windows, len(windows[0])), replace=False)
+
+    return [X[np.sort(sample)] for X in windows]
+
+
+def quantize_model(model, quantization, calibration_data=None):
+    """`model` as is for fp32, or its dynamic or static int8 quantisation, which runs on CPU."""
+    if quantization == 'fp32':
+        return model
+    if quantization == 'dynamic':
+        return quantize_model_dynamic(model)
+    if quantization == 'static':
+        if calibration_data is None:
+            raise ValueError('Static quantisation needs calibration data.')
+        return quantize_model_static(model, calibration_data)
+    raise ValueError(f'Unknown quantization {quantization}. Please select one of {", ".join(QUANTIZATIONS)}.')
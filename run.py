@@ -1,8 +1,10 @@
+from concurrent.futures import ProcessPoolExecutor
 from functools import partial
 import argparse
+import copy
 import datetime
-import itertools
 import math
+import multiprocessing
 import os
 import pickle
 import random
@@ -12,14 +14,14 @@ import matplotlib.pyplot as plt
 from sklearn.metrics import precision_recall_curve, roc_auc_score
 import numpy as np
 import pandas as pd
+import torch.distributed as dist
 import torch.nn as nn
 import torch.optim as optim
 import torch.utils.data.distributed
-from torch.utils.data import TensorDataset
 from tqdm import tqdm
 import utils
 from sklearn.metrics import roc_auc_score
-from dataloader import create_train_val_v2, _construct_output_data_alt, load_evaluation_data
+from dataloader import create_train_val_features, load_evaluation_data, WindowedTrajectoryDataset
 from trajectories import assemble_ground_truth_and_reconstructions, load_anomaly_masks, compute_rnn_ae_reconstruction_errors, summarise_reconstruction_errors, discard_information_from_padded_frames
 from utils import batch_inference
 from models.trajrec import trajrec_tiny, trajrec_small, trajrec_base, trajrec_large, trajrec_huge, TrajREC
@@ -29,44 +31,127 @@ import wandb
 
 
 @torch.no_grad()
-def prediction_auc_score(model, data, reconstruct_original_data=True, batch_size=None, setting='future', is_avenue=False,
-                         elsec_data=False):
+def score_cameras(model, data, settings, reconstruct_original_data=True, batch_size=None, elsec_data=False,
+                  precision='fp32'):
+    """
+    Frame level scores of every camera of `data` under each of the `settings`, as a list with, for every camera, a dict
+    mapping the settings to `(y_true, y_hat, y_grouped_true, y_grouped_hat)`.
+    """
     input_length = model.input_length
     pred_length = model.prediction_length
 
-    all_y_true, all_y_hat = [], []
-    all_y_grouped_true, all_y_grouped_hat = {}, {}
-    
-    for anomaly_masks, trajectories_ids, frames, X_global, X_local, X_out in data:
+    camera_scores = []
+    for anomaly_masks, trajectories_ids, frames, X_global, X_local, X_out, trajectory_names, trajectory_videos, \
+            video_names in data:
         predicted_frames = frames[:, :pred_length] + input_length
         predicted_ids = trajectories_ids[:, :pred_length]
         
-        out, target = batch_inference(model, [X_global, X_local, X_out], batch_size=batch_size, setting=setting)
-        predicted_global, predicted_local, predicted_out = out
-        
-        X = X_out if reconstruct_original_data else np.concatenate((X_global, X_local), axis=-1)
-        #y = retrieve_future_skeletons(trajectories_ids, X, pred_length)
-        y = target[-1]
-        predicted_y = predicted_out if reconstruct_original_data else np.concatenate((predicted_global, predicted_local), axis=-1)
+        results = batch_inference(model, [X_global, X_local, X_out], batch_size=batch_size, setting=settings,
+                                  precision=precision)
+        camera_scores.append({})
+        for setting, (out, target) in zip(settings, results):
+            predicted_global, predicted_local, predicted_out = out
+            
+            #y = retrieve_future_skeletons(trajectories_ids, X, pred_length)
+            y = target[-1]
+            predicted_y = predicted_out if reconstruct_original_data else np.concatenate((predicted_global, predicted_local), axis=-1)
 
-        pred_errors = compute_rnn_ae_reconstruction_errors(y, predicted_y, 'mse')
-        
-        if setting=='past':
-            pred_errors = pred_errors[:,:pred_length]
-        elif setting=='future':
-            pred_errors = pred_errors[:,input_length:]
-        else:
-            pred_errors = pred_errors[:,input_length//2:input_length//2+pred_length]
-                    
-        pred_ids, pred_frames, pred_errors = discard_information_from_padded_frames(predicted_ids, predicted_frames,
-                                                                                    pred_errors, pred_length)
-        pred_ids, pred_frames, pred_errors = summarise_reconstruction_errors(pred_errors, pred_frames, pred_ids)
-        y_true_pred, y_hat_pred, y_grouped_true, y_grouped_hat = assemble_ground_truth_and_reconstructions(
-            anomaly_masks, pred_ids, pred_frames, pred_errors, return_grouped_scores=True, elsec_data=elsec_data)
-        all_y_true.append(y_true_pred)
-        all_y_hat.append(y_hat_pred)
-        all_y_grouped_true.update(y_grouped_true)
-        all_y_grouped_hat.update(y_grouped_hat)
+            pred_errors = compute_rnn_ae_reconstruction_errors(y, predicted_y, 'mse')
+            
+            if setting=='past':
+                pred_errors = pred_errors[:,:pred_length]
+            elif setting=='future':
+                pred_errors = pred_errors[:,input_length:]
+            else:
+                pred_errors = pred_errors[:,input_length//2:input_length//2+pred_length]
+                        
+            pred_ids, pred_frames, pred_errors = discard_information_from_padded_frames(predicted_ids, predicted_frames,
+                                                                                        pred_errors, pred_length)
+            pred_ids, pred_frames, pred_errors = summarise_reconstruction_errors(pred_errors, pred_frames, pred_ids)
+            camera_scores[-1][setting] = assemble_ground_truth_and_reconstructions(
+                anomaly_masks, pred_ids, pred_frames, pred_errors, return_grouped_scores=True, elsec_data=elsec_data,
+                trajectory_names=trajectory_names, trajectory_videos=trajectory_videos, video_names=video_names)
+
+    return camera_scores
+
+
+def _score_cameras_in_worker(model, shard, data, load_cameras, settings, num_threads, **kwargs):
+    torch.set_num_threads(num_threads)
+    if data is None:
+        data = load_cameras(shard)
+    return score_cameras(model, data, settings, **kwargs)
+
+
+def score_cameras_in_parallel(model, data, settings, workers, load_cameras=None, **kwargs):
+    """
+    `score_cameras` with the cameras shared out between `workers` processes, balanced by number of windows. Each worker
+    scores its cameras with its own copy of the model on the CPU, using its share of the CPU threads.
+
+    The arrays of the cameras are pickled into the workers, unless `load_cameras` is given: a picklable function
+    returning the cameras at a list of indices of `data`, with which every worker loads its own cameras, e.g. memory
+    mapped from the cache (see `load_test_cameras`).
+    """
+    shards = [[] for _ in range(workers)]
+    shard_sizes = [0] * workers
+    for index in sorted(range(len(data)), key=lambda index: -len(data[index][1])):
+        shard = shard_sizes.index(min(shard_sizes))
+        shards[shard].append(index)
+        shard_sizes[shard] += len(data[index][1])
+
+    model = copy.deepcopy(model).cpu()
+    num_threads = max(1, torch.get_num_threads() // workers)
+    camera_scores = [None] * len(data)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = [executor.submit(_score_cameras_in_worker, model, shard,
+                                   None if load_cameras is not None else [data[index] for index in shard],
+                                   load_cameras, settings, num_threads, **kwargs) for shard in shards if shard]
+        for shard, future in zip([shard for shard in shards if shard], futures):
+            for index, scores in zip(shard, future.result()):
+                camera_scores[index] = scores
+
+    return camera_scores
+
+
+def auc_scores(camera_scores, settings, is_avenue=False):
+    """
+    ROC AUC of every setting over the scores of all cameras, returned together with the grouped per-video scores.
+    """
+    scores = {}
+    for setting in settings:
+        all_y_true = [camera[setting][0] for camera in camera_scores]
+        all_y_hat = [camera[setting][1] for camera in camera_scores]
+        all_y_grouped_true, all_y_grouped_hat = {}, {}
+        for camera in camera_scores:
+            all_y_grouped_true.update(camera[setting][2])
+            all_y_grouped_hat.update(camera[setting][3])
+        scores[setting] = (_auc_score(all_y_true, all_y_hat, is_avenue), all_y_grouped_true, all_y_grouped_hat)
+
+    return scores
+
+
+def prediction_auc_score(model, data, reconstruct_original_data=True, batch_size=None, setting='future', is_avenue=False,
+                         elsec_data=False, precision='fp32', workers=0, load_cameras=None):
+    """
+    `setting` may also be a sequence of settings, in which case the test data is run through the model only once for
+    all of them and a dict mapping every setting to its scores is returned. With `workers` > 1 the cameras are scored
+    by that many processes, which load them with `load_cameras` if given (see `score_cameras_in_parallel`).
+    """
+    single_setting = isinstance(setting, str)
+    settings = [setting] if single_setting else setting
+
+    kwargs = dict(reconstruct_original_data=reconstruct_original_data, batch_size=batch_size, elsec_data=elsec_data,
+                  precision=precision)
+    if workers > 1 and len(data) > 1:
+        camera_scores = score_cameras_in_parallel(model, data, settings, min(workers, len(data)),
+                                                  load_cameras=load_cameras, **kwargs)
+    else:
+        camera_scores = score_cameras(model, data, settings, **kwargs)
+
+    scores = auc_scores(camera_scores, settings, is_avenue)
+    return scores[settings[0]] if single_setting else scores
+
+
+def _auc_score(all_y_true, all_y_hat, is_avenue):
     all_y_true = np.concatenate(all_y_true)
     all_y_hat = np.concatenate(all_y_hat)
     
@@ -108,42 +193,50 @@ def prediction_auc_score(model, data, reconstruct_original_data=True, batch_size
     # Save the plot to a file
     plt.savefig('precision_recall_curve.png')
     plt.close()
-    return roc_auc_score(all_y_true, all_y_hat), all_y_grouped_true, all_y_grouped_hat
+    return roc_auc_score(all_y_true, all_y_hat)
 
 
-def create_train_val_datasets(args):
-    x_train, y_train, val_data, train_trajectories, val_trajectories, bb_scaler, joint_scaler, out_scaler = \
-            create_train_val_v2(trajectories_path=args['trajectories'], video_resolution=args['video_resolution'],
-                                input_length=args['input_length'], pred_length=args['pred_length'], elsec_data=args['elsec_data'])
-
-    x_global_train, x_local_train, x_out_train = x_train
-    x_local_train = x_local_train.astype(np.float32)
-    x_out_train = x_out_train.astype(np.float32)
-    x_global_val, x_local_val, x_out_val = val_data[0]
-    x_local_val = x_local_val.astype(np.float32)
-    x_out_val = x_out_val.astype(np.float32)
-
-    if y_train is not None:  # yes
-        y_global_train, y_local_train, y_out_train = y_train
-        y_global_val, y_local_val, y_out_val = val_data[1]
-    else:
-        y_global_train = y_local_train = y_out_train = y_global_val = y_local_val = y_out_val = None
+def load_test_data(testdata, camera_ids, scalers, input_length, pred_length, res, elsec_data=False, load_workers=0,
+                   use_cache=True):
+    """The anomaly masks and the evaluation windows of every camera of `camera_ids`, as expected by `score_cameras`."""
+    bb_scaler, joint_scaler, out_scaler = scalers
+    data_test = []
+    for camera_id in camera_ids:
+        tpath = os.path.join(os.path.join(testdata, 'trajectories'), camera_id)
+        if elsec_data == True:
+           masks = load_anomaly_masks_elsec(os.path.join(testdata, 'frame_level_masks', camera_id))
+        else:
+            masks = load_anomaly_masks(os.path.join(testdata, 'frame_level_masks', camera_id))
+        ids, frames, X_bb, X_joints, X_out, _, _, _, names, videos, video_names = \
+            load_evaluation_data(bb_scaler, joint_scaler, out_scaler, tpath, inp_len=input_length, inp_gap=0,
+                                 pred_len=pred_length, res=res, bb_norm='zero_one', joint_norm='zero_one',
+                                 out_norm='zero_one', rec_data=True, sort='avenue' in testdata.lower(),
+                                 elsec_data=elsec_data, load_workers=load_workers, use_cache=use_cache)
+        data_test.append((masks, ids, frames, X_bb, X_joints, X_out, names, videos, video_names))
 
-    y = _construct_output_data_alt(True, args['rec_length'], args['reconstruct_reverse'],
-                                   args['pred_length'], x_out_train, y_out_train,
-                                   x_global_train, y_global_train, x_local_train, y_local_train)
-    y_val = _construct_output_data_alt(True, args['rec_length'], args['reconstruct_reverse'],
-                                       args['pred_length'], x_out_val, y_out_val,
-                                       x_global_val, y_global_val, x_local_val, y_local_val)
+    return data_test
 
-    X = (x_global_train, x_local_train, x_out_train)
-    X_val = (x_global_val, x_local_val, x_out_val)
 
-    train_tensors = [torch.from_numpy(d) for d in itertools.chain(X, (a.copy() for a in y))]
-    val_tensors = [torch.from_numpy(d) for d in itertools.chain(X_val, (a.copy() for a in y_val))]
-    
-    return x_local_train.shape[-1], TensorDataset(*train_tensors), TensorDataset(*val_tensors), \
-            bb_scaler, joint_scaler, out_scaler
+def load_test_cameras(indices, testdata, camera_ids, scalers, **kwargs):
+    """`load_test_data` for the cameras at `indices` of `camera_ids`, for `score_cameras_in_parallel`."""
+    return load_test_data(testdata, [camera_ids[index] for index in indices], scalers, **kwargs)
+
+
+def create_train_val_datasets(args):
+    (features_train, offsets_train), (features_val, offsets_val), bb_scaler, joint_scaler, out_scaler = \
+            create_train_val_features(trajectories_path=args['trajectories'], video_resolution=args['video_resolution'],
+                                      input_length=args['input_length'], pred_length=args['pred_length'],
+                                      elsec_data=args['elsec_data'], load_workers=args['load_workers'])
+
+    # The segments are cut from the per-frame features when a batch is requested, instead of being stacked up front.
+    dataset_train = WindowedTrajectoryDataset(features_train, offsets_train, args['input_length'],
+                                              pred_length=args['pred_length'], rec_length=args['rec_length'],
+                                              reconstruct_reverse=args['reconstruct_reverse'])
+    dataset_val = WindowedTrajectoryDataset(features_val, offsets_val, args['input_length'],
+                                            pred_length=args['pred_length'], rec_length=args['rec_length'],
+                                            reconstruct_reverse=args['reconstruct_reverse'])
+
+    return features_train[1].shape[-1], dataset_train, dataset_val, bb_scaler, joint_scaler, out_scaler
 
 def load_anomaly_masks_elsec(anomaly_masks_path):
     file_names = os.listdir(anomaly_masks_path)
@@ -164,6 +257,17 @@ def run(args):
     os.environ['WANDB_API_KEY'] = '26fa19cef62de16bb9c521aa45d45d8e1c53e7ce'
     print(f"WANDB_API_KEY set to: {os.environ['WANDB_API_KEY']}")
     print(args)
+    # Under torchrun every process trains on its own shard of the data, only rank 0 evaluating, logging and saving.
+    if args['distributed']:
+        if args['parallel']:
+            raise ValueError('--parallel and --distributed cannot be combined: --distributed already runs one process '
+                             'per device.')
+        # The other processes wait for rank 0 to preprocess the data, which may outlast the default timeout.
+        dist.init_process_group(backend=args['dist_backend'],
+                                timeout=datetime.timedelta(minutes=args['dist_timeout']))
+    is_main = not args['distributed'] or dist.get_rank() == 0
+    if not is_main:
+        args = dict(args, wandb=False)
     random.seed(args['seed'])
     np.random.seed(args['seed'])
     torch.manual_seed(args['seed'])
@@ -211,33 +315,48 @@ def run(args):
         pass
 
     device = torch.device(args['gpu_id'] if args['gpu_id'] != -1 else "cpu")
+    if args['distributed'] and device.type == 'cuda':
+        device = torch.device('cuda', int(os.environ['LOCAL_RANK']))
+        torch.cuda.set_device(device)
 
+    # The other processes wait for rank 0 to preprocess the training data, and then read it from the cache.
+    if not is_main:
+        dist.barrier()
     local_input_dim,dataset_train,dataset_val,bb_scaler,joint_scaler,out_scaler=create_train_val_datasets(args)
+    if args['distributed'] and is_main:
+        dist.barrier()
     global_input_dim = 4
 
     print(f'Num of skeletons sequences: {len(dataset_train)} train, {len(dataset_val)} val')
 
     res = np.array([int(dim) for dim in args['video_resolution'].split('x')], dtype=np.float32)
-    data_test = []
-    for camera_id in sorted(os.listdir(os.path.join(args['testdata'], 'trajectories'))):
-        tpath = os.path.join(os.path.join(args['testdata'], 'trajectories'), camera_id)
-        if args["elsec_data"] == True:
-           masks = load_anomaly_masks_elsec(os.path.join(args['testdata'], 'frame_level_masks', camera_id))
-        else:
-            masks = load_anomaly_masks(os.path.join(args['testdata'], 'frame_level_masks', camera_id))
-        ids, frames, X_bb, X_joints, X_out, _, _, _ = load_evaluation_data(bb_scaler,joint_scaler,out_scaler,tpath,
-                                                                           inp_len=args['input_length'],inp_gap=0,
-                                                                           pred_len=args['pred_length'],res=res,
-                                                                           bb_norm='zero_one',joint_norm='zero_one',
-                                                                           out_norm='zero_one', rec_data=True,
-                                                                           sort='avenue' in args['testdata'].lower(),
-                                                                           elsec_data=args['elsec_data'])
-        data_test.append((masks, ids, frames, X_bb, X_joints, X_out))
-    
-
-    train_loader = torch.utils.data.DataLoader(dataset_train, shuffle=True, batch_size=args['batch_size'], num_workers=4, pin_memory=True)
+    # With --distributed, every process holds and scores its own share of the test cameras.
+    camera_ids = sorted(os.listdir(os.path.join(args['testdata'], 'trajectories')))
+    if args['distributed']:
+        camera_ids = camera_ids[dist.get_rank()::dist.get_world_size()]
+    data_test = load_test_data(args['testdata'], camera_ids, (bb_scaler, joint_scaler, out_scaler),
+                               input_length=args['input_length'], pred_length=args['pred_length'], res=res,
+                               elsec_data=args['elsec_data'], load_workers=args['load_workers'],
+                               use_cache=args['eval_cache'])
+    # The scoring workers map the cached arrays of their cameras themselves, instead of receiving copies of them.
+    load_cameras = None
+    if args['eval_cache']:
+        load_cameras = partial(load_test_cameras, testdata=args['testdata'], camera_ids=camera_ids,
+                               scalers=(bb_scaler, joint_scaler, out_scaler), input_length=args['input_length'],
+                               pred_length=args['pred_length'], res=res, elsec_data=args['elsec_data'])
+
+
+    # With --distributed, --batch_size is the batch size of every process.
+    if args['distributed']:
+        train_sampler = torch.utils.data.distributed.DistributedSampler(dataset_train, shuffle=True, seed=args['seed'])
+        val_sampler = torch.utils.data.distributed.DistributedSampler(dataset_val, shuffle=False)
+    else:
+        train_sampler = torch.utils.data.RandomSampler(dataset_train)
+        val_sampler = torch.utils.data.SequentialSampler(dataset_val)
+    # The loaders hand whole batches of indices to the datasets, which cut all their segments at once.
+    train_loader = torch.utils.data.DataLoader(dataset_train, sampler=torch.utils.data.BatchSampler(train_sampler, args['batch_size'], drop_last=False), batch_size=None, num_workers=4, pin_memory=True)
 
-    val_loader = torch.utils.data.DataLoader(dataset_val, shuffle=False, batch_size=args['batch_size'], num_workers=0, pin_memory=False)
+    val_loader = torch.utils.data.DataLoader(dataset_val, sampler=torch.utils.data.BatchSampler(val_sampler, args['batch_size'], drop_last=False), batch_size=None, num_workers=0, pin_memory=False)
 
 
     if 'trajrec' in args['model']:
@@ -269,11 +388,16 @@ def run(args):
         model.load_state_dict(torch.load(args['chkp'], map_location=device)["model"])
         print(f"Loaded pretrained weights for the model")
 
+    model_without_ddp = model
+    if args['distributed']:
+        model = nn.parallel.DistributedDataParallel(model, device_ids=[device] if device.type == 'cuda' else None)
+
     optimizer = optim.Adam(model.parameters(), lr=args['lr'], weight_decay=args['weight_decay'])
     scheduler = optim.lr_scheduler. MultiStepLR(optimizer, milestones=[100], gamma=0.5)
 
     logname = 'logs/' + datetime.datetime.now().strftime('%Y%m%d_%Hh%M') if args['logname'] is None else args['logname']
-    scaler = torch.cuda.amp.GradScaler()
+    # Loss scaling is only needed for the fp16 gradients, which underflow otherwise.
+    scaler = torch.cuda.amp.GradScaler(enabled=args['precision'] == 'fp16' and device.type == 'cuda')
     bformat='{l_bar}{bar}| {n_fmt}/{total_fmt} {rate_fmt}{postfix}'
     
     max_AUC = {'past':0., 'present':0., 'future':0.}
@@ -284,19 +408,24 @@ def run(args):
         if args['eval_only'] and epoch>0:
             break
         
-        print("Epoch: %02d"%epoch)
+        if is_main:
+            print("Epoch: %02d"%epoch)
+        if args['distributed']:
+            train_sampler.set_epoch(epoch)
         stats = {}
+        test_aucs = {}
         if args['eval_only']:
             phases = ['val,past', 'val,present', 'val,future']
         else:
             phases = ['train', 'val,past', 'val,present', 'val,future']
         for phase in phases:
             loss_meter = utils.AverageMeter()
+            pending_losses, pending_sizes = [], []
             
             if phase == 'train':
-                pbar = tqdm(enumerate(train_loader), total=len(train_loader), bar_format=bformat, ascii='░▒█')
+                pbar = tqdm(enumerate(train_loader), total=len(train_loader), bar_format=bformat, ascii='░▒█', disable=not is_main)
             else:
-                pbar = tqdm(enumerate(val_loader), total=len(val_loader), bar_format=bformat, ascii='░▒█')
+                pbar = tqdm(enumerate(val_loader), total=len(val_loader), bar_format=bformat, ascii='░▒█', disable=not is_main)
                 
             with torch.set_grad_enabled(phase == 'train'):
                 
@@ -314,53 +443,104 @@ def run(args):
                     # Convert all input tensors to float32 to avoid dtype mismatch
                     inputs_sk = [tensor.to(torch.float32) for tensor in inputs_sk]
 
-                    losses,eloss,output,target_sk = model(inputs_sk,setting,compute_loss=True)
+                    with utils.autocast(device, args['precision']):
+                        losses,eloss,output,target_sk = model(inputs_sk,setting,compute_loss=True)
                     if phase=='train':
                         loss = sum(losses[:-1]) + eloss
                     else:
                         loss = losses[-1]
                     
-                    if not math.isfinite(loss):
-                        print("Loss is {}, stopping training".format(loss.item()))
-                        if args['wandb']:
-                            wandb.finish()
-                        return [v[0] for v in stats.values()], [v[1] for v in stats.values()]
-            
-                    loss_meter.update(loss.item(), inputs_sk[0].shape[0])
-                    pbar.set_description(f"[{epoch + 1}/{args['epochs']}]")
-                    pbar.set_postfix_str(f"[{loss_meter.avg:.2e}|{loss.item():.2e}]")
-                    pbar.update()  
-
+                    skip_update = False
                     if phase == 'train':
-                        if args['wandb']:
-                            wandb.log({"train_loss_per_step": loss,
-                                        "train_global_loss_per_step": losses[0],
-                                        "train_local_loss_per_step": losses[1],
-                                        "train_out_loss_per_step": losses[2],
-                                        "lr_per_step": optimizer.param_groups[0]["lr"], 
-                                    })
+                        # A non-finite loss must not update the weights, so whether it is finite is read back before
+                        # every update, on all processes together.
+                        finite = torch.isfinite(loss.detach()).to(torch.int32)
+                        if args['distributed']:
+                            dist.all_reduce(finite, op=dist.ReduceOp.MIN)
+                        skip_update = not finite.item()
+                    if phase == 'train' and not skip_update:
                         optimizer.zero_grad()
                         scaler.scale(loss).backward()
                         scaler.step(optimizer)
                         scaler.update()
                         #scheduler.step()
-                    elif args['wandb']:
-                        wandb.log({f"val_{setting}_loss_per_step": loss,
-                                    f"val_{setting}_global_loss_per_step": losses[0],
-                                    f"val_{setting}_local_loss_per_step": losses[1],
-                                    f"val_{setting}_out_loss_per_step": losses[2], 
-                                    })
+
+                    # Reading the losses back makes the host wait for the device, so they are kept on the device and
+                    # only read back and logged every `log_every` steps, or at once to stop after a skipped update.
+                    pending_losses.append(torch.stack([loss, *losses[:3]]).detach())
+                    pending_sizes.append(inputs_sk[0].shape[0])
+                    pbar.update()  
+                    if len(pending_losses) == args['log_every'] or iteration + 1 == pbar.total or skip_update:
+                        step_losses = torch.stack(pending_losses).float()
+                        step_sizes = torch.tensor(pending_sizes, dtype=torch.float32, device=step_losses.device)
+                        if args['distributed']:
+                            # averaged over the processes, which all see the same number of batches
+                            step_losses = step_losses * step_sizes[:, None]
+                            dist.all_reduce(step_losses)
+                            dist.all_reduce(step_sizes)
+                            step_losses = step_losses / step_sizes[:, None]
+                        for (step_loss, global_loss, local_loss, out_loss), size in zip(
+                                step_losses.cpu().tolist(), step_sizes.cpu().tolist()):
+                            if not math.isfinite(step_loss):
+                                print("Loss is {}, stopping training".format(step_loss))
+                                if args['wandb']:
+                                    wandb.finish()
+                                if args['distributed']:
+                                    dist.destroy_process_group()
+                                return [v[0] for v in stats.values()], [v[1] for v in stats.values()]
+
+                            loss_meter.update(step_loss, size)
+                            if phase == 'train' and args['wandb']:
+                                wandb.log({"train_loss_per_step": step_loss,
+                                            "train_global_loss_per_step": global_loss,
+                                            "train_local_loss_per_step": local_loss,
+                                            "train_out_loss_per_step": out_loss,
+                                            "lr_per_step": optimizer.param_groups[0]["lr"], 
+                                        })
+                            elif args['wandb']:
+                                wandb.log({f"val_{setting}_loss_per_step": step_loss,
+                                            f"val_{setting}_global_loss_per_step": global_loss,
+                                            f"val_{setting}_local_loss_per_step": local_loss,
+                                            f"val_{setting}_out_loss_per_step": out_loss, 
+                                            })
+                        pending_losses, pending_sizes = [], []
+                        pbar.set_description(f"[{epoch + 1}/{args['epochs']}]")
+                        pbar.set_postfix_str(f"[{loss_meter.avg:.2e}|{step_loss:.2e}]")
                     
                     # cleanup GPU RAM
                     del inputs_sk, target_sk, output, loss
                     
                 if 'val' in phase:
                     
-                    auc_pred, _, _ = prediction_auc_score(model, data_test, reconstruct_original_data=True,
-                                                batch_size=args['batch_size'], setting=setting, is_avenue='avenue' in args['trajectories'].lower(),
-                                                          elsec_data=args['elsec_data'])
-
-                    print(f'Test setting {setting}: [MSE: {loss_meter.avg:.6f} | AUC: {auc_pred:.4f}]')
+                    # The test set is scored under every validation setting at once, on the first validation phase.
+                    if not test_aucs:
+                        val_settings = [p.split(',')[-1] for p in phases if 'val' in p]
+                        if args['distributed']:
+                            # the scores of every process's cameras are gathered on rank 0, back in camera order
+                            camera_scores = score_cameras(model_without_ddp, data_test, val_settings, reconstruct_original_data=True,
+                                                          batch_size=args['batch_size'], elsec_data=args['elsec_data'], precision=args['precision'])
+                            gathered = [None] * dist.get_world_size() if is_main else None
+                            dist.gather_object(camera_scores, gathered, dst=0)
+                            if is_main:
+                                num_cameras = sum(len(scores) for scores in gathered)
+                                camera_scores = [gathered[index % len(gathered)][index // len(gathered)] for index in range(num_cameras)]
+                                test_aucs = {s: scores[0] for s, scores in auc_scores(camera_scores, val_settings,
+                                                                                      'avenue' in args['trajectories'].lower()).items()}
+                        else:
+                            test_scores = prediction_auc_score(model_without_ddp, data_test, reconstruct_original_data=True,
+                                                batch_size=args['batch_size'], setting=val_settings, is_avenue='avenue' in args['trajectories'].lower(),
+                                                          elsec_data=args['elsec_data'], precision=args['precision'], workers=args['eval_workers'],
+                                                          load_cameras=load_cameras)
+                            test_aucs = {s: scores[0] for s, scores in test_scores.items()}
+                        if args['distributed']:
+                            # the other processes receive the AUCs from rank 0
+                            test_aucs = [test_aucs]
+                            dist.broadcast_object_list(test_aucs, src=0)
+                            test_aucs = test_aucs[0]
+                    auc_pred = test_aucs[setting]
+
+                    if is_main:
+                        print(f'Test setting {setting}: [MSE: {loss_meter.avg:.6f} | AUC: {auc_pred:.4f}]')
                     stats[setting] = [loss_meter.avg,auc_pred]
                     if args['wandb']:
                         wandb.log({"epoch": epoch,
@@ -379,12 +559,13 @@ def run(args):
         if sum_auc > sum([v for v in max_AUC.values()])/len(max_AUC): 
             for s in stats.keys():
                 max_AUC[s] = stats[s][1]
-                if args['save_best']:
-                    state = {'model_name': args['model'], 'model': model.state_dict(), 'epoch': epoch,
-                    'input_length': model.input_length, 'prediction_length': model.prediction_length,
+                if args['save_best'] and is_main:
+                    state = {'model_name': args['model'], 'model': model_without_ddp.state_dict(), 'epoch': epoch,
+                    'input_length': model_without_ddp.input_length, 'prediction_length': model_without_ddp.prediction_length,
                     'bb_scaler': bb_scaler, 'joint_scaler': joint_scaler, 'out_scaler': out_scaler}
                     torch.save(state, 'best_ckpt_elsec.pt')
-        print(f"AVG : [MSE: {sum_mae:.6f} | AUC: {sum_auc:.4f}]")
+        if is_main:
+            print(f"AVG : [MSE: {sum_mae:.6f} | AUC: {sum_auc:.4f}]")
         if args['wandb']:
             wandb.log({f"max_AUC_{setting}": max_AUC[setting] for setting in max_AUC.keys()})
             wandb.log({"epoch": epoch,
@@ -392,15 +573,18 @@ def run(args):
                     "val_avg_AUC": sum_auc
                     })        
         scheduler.step()
-        state = {'model_name': args['model'], 'model': model.state_dict(), 'epoch': epoch,
-                'input_length': model.input_length, 'prediction_length': model.prediction_length,
-                'bb_scaler': bb_scaler, 'joint_scaler': joint_scaler, 'out_scaler': out_scaler}
-        if not os.path.isdir(logname):
-            os.makedirs(logname)
-        torch.save(state, f'{logname}/ckpt{epoch}.pt')
+        if is_main:
+            state = {'model_name': args['model'], 'model': model_without_ddp.state_dict(), 'epoch': epoch,
+                    'input_length': model_without_ddp.input_length, 'prediction_length': model_without_ddp.prediction_length,
+                    'bb_scaler': bb_scaler, 'joint_scaler': joint_scaler, 'out_scaler': out_scaler}
+            if not os.path.isdir(logname):
+                os.makedirs(logname)
+            torch.save(state, f'{logname}/ckpt{epoch}.pt')
     if args['wandb']:
         wandb.log({f"max_AUC_{setting}": max_AUC[setting] for setting in max_AUC.keys()}) 
         wandb.finish()
+    if args['distributed']:
+        dist.destroy_process_group()
     return max_AUC
 
 
@@ -410,6 +594,13 @@ if __name__=='__main__':
     parser.add_argument('--seed', default=0, type=int, help='Randomness seed for reproducible training')
     parser.add_argument('--gpu_id', default=0, type=int, help='Which GPUs to use. -1 for cpu')
     parser.add_argument('--parallel', default=False, type=lambda x: (str(x).lower() == 'true'), help='Perform dataparallel training.')
+    parser.add_argument('--distributed', default=False, type=lambda x: (str(x).lower() == 'true'),
+                        help='Perform distributed data parallel training, one process per device, launched with torchrun.')
+    parser.add_argument('--dist_backend', default='gloo', choices=['gloo', 'nccl'],
+                        help='Backend of the distributed training. gloo also runs on CPU-only machines.')
+    parser.add_argument('--dist_timeout', default=120, type=int,
+                        help='Minutes the distributed processes wait for each other, e.g. while rank 0 preprocesses '
+                             'the data.')
     parser.add_argument('--trajectories', type=str, required=True,
                         help='Path to directory containing training trajectories. For each video in the '
                                 'training set, there must be a folder inside this directory containing the '
@@ -459,6 +650,18 @@ if __name__=='__main__':
     parser.add_argument('--save_best',default=True,type=lambda x: (str(x).lower() == 'true'),help='Bool if to save the checkpoint with best (avg) AUC')
     parser.add_argument('--eval_only',default=False,type=lambda x: (str(x).lower() == 'true'),help='Bool if to only run inference.')
     parser.add_argument('--elsec_data',default=False,type=bool,help='Bool if to use elsec data')
+    parser.add_argument('--load_workers', default=0, type=int,
+                        help='Number of processes parsing the trajectory csv files in parallel. 0 parses them serially.')
+    parser.add_argument('--eval_cache', default=True, type=lambda x: (str(x).lower() == 'true'),
+                        help='Bool if to cache the preprocessed test data of every camera on disk and reuse it.')
+    parser.add_argument('--eval_workers', default=0, type=int,
+                        help='Number of processes scoring the test cameras in parallel, each with a CPU copy of the model. '
+                             '0 scores them in the training process.')
+    parser.add_argument('--precision', default='fp32', choices=list(utils.PRECISIONS),
+                        help='Precision the model runs in: fp32, or autocast to bf16 (also on CPU) or fp16.')
+    parser.add_argument('--log_every', default=1, type=int,
+                        help='Number of steps between reading the losses back from the device to log them. Whether the '
+                             'training loss is finite is still checked before every update.')
 
     _args = parser.parse_args()
     # _args.elsec_data = True
@@ -0,0 +1,214 @@
+import argparse
+import sys
+import time
+
+import numpy as np
+import torch
+
+from models.trajrec import load_trajrec_checkpoint
+from trajectories import compute_rnn_ae_reconstruction_errors, extract_coordinate_features, load_trajectories, \
+    scale_trajectories
+from utils import PRECISIONS, autocast
+
+
+def extract_scaled_features(coordinates, video_resolution, scalers):
+    """The global, local and out features of a (N, 34) array of skeletons in image coordinates, normalised by `scalers`."""
+    features = extract_coordinate_features(coordinates, video_resolution=video_resolution)
+    return [scale_trajectories(X, scaler=scaler, strategy='zero_one')[0] for X, scaler in zip(features, scalers)]
+
+
+class TrackFeatureState:
+    """
+    The normalised model features and the frame numbers of the last `length` detections of a track. The features of a
+    detection are computed once, when it is pushed, and every row is written twice, `length` rows apart, so that the
+    latest window is always a contiguous slice of the buffers and `window` returns views instead of copies.
+    """
+
+    def __init__(self, length, feature_dims):
+        self.length = length
+        self.features = [np.zeros((2 * length, dim), dtype=np.float32) for dim in feature_dims]
+        self.frames = np.zeros(2 * length, dtype=np.int64)
+        self.size = 0
+        self.last_frame = None
+
+    def push(self, frame, features):
+        index = self.size % self.length
+        for buffer, row in zip(self.features, features):
+            buffer[index] = buffer[index + self.length] = row
+        self.frames[index] = self.frames[index + self.length] = frame
+        self.size += 1
+        self.last_frame = frame
+
+    def is_full(self):
+        return self.size >= self.length
+
+    def window(self):
+        """Views of the features and the frames of the buffered detections, oldest first."""
+        start = (self.size % self.length) if self.is_full() else 0
+        return [buffer[start:start + self.length] for buffer in self.features], self.frames[start:start + self.length]
+
+
+class StreamingScorer:
+    """
+    Online anomaly scoring of skeleton tracks with a TrajREC model.
+
+    Every call to `update` normalises the detections of one frame, keyed by track id, with the training scalers and
+    pushes their features into a `TrackFeatureState` per track holding its last `input_length + prediction_length`
+    detections, so that the features of every detection are computed only once. The windows of all the tracks detected
+    in the frame are scored together in one forward pass of the model (in chunks of at most `max_batch_size` windows),
+    and the errors of the masked positions are averaged per track and frame, as in the
+    offline evaluation. A frame is scored with the maximum over its tracks as soon as no later window can cover it,
+    that is `latency` frames after it was ingested. The windows of tracks with gaps in their detections can reach
+    frames that were already scored, whose errors are then dropped.
+    """
+
+    def __init__(self, model, global_scaler, local_scaler, out_scaler, video_resolution, setting='future',
+                 precision='fp32', max_batch_size=None, max_idle_frames=None):
+        self.model = model.eval()
+        self.device = next(model.parameters()).device
+        self.scalers = [global_scaler, local_scaler, out_scaler]
+        self.video_resolution = np.asarray(video_resolution, dtype=np.float32)
+        self.setting = setting
+        self.precision = precision
+        self.max_batch_size = max_batch_size
+        self.window_length = model.input_length + model.prediction_length
+        self.max_idle_frames = self.window_length if max_idle_frames is None else max_idle_frames
+
+        # positions of the window that the model predicts in this setting, and thus scores
+        mask = getattr(model.masking, f'mask_{setting}').reshape(-1).cpu().numpy()
+        self.scored_positions = np.flatnonzero(mask == 0)
+        self.latency = self.window_length - 1 - int(self.scored_positions.min())
+
+        self.tracks = {}
+        self.errors = {}
+        self.next_frame = None
+        self.last_frame = None
+
+    @classmethod
+    def from_checkpoint(cls, path, video_resolution, device='cpu', **kwargs):
+        model, checkpoint = load_trajrec_checkpoint(path, map_location=device)
+        return cls(model.to(device), checkpoint['bb_scaler'], checkpoint['joint_scaler'], checkpoint['out_scaler'],
+                   video_resolution, **kwargs)
+
+    def update(self, frame, detections):
+        """
+        Ingest the detections of `frame`, a dict mapping track ids to their (34,) keypoints, and return the list of
+        `(frame, score)` pairs of the frames that became final, in order.
+        """
+        if self.next_frame is None:
+            self.next_frame = frame
+        self.last_frame = frame
+        if detections:
+            features = extract_scaled_features(np.stack(list(detections.values())), self.video_resolution, self.scalers)
+            for index, track_id in enumerate(detections):
+                if track_id not in self.tracks:
+                    self.tracks[track_id] = TrackFeatureState(self.window_length, [X.shape[-1] for X in features])
+                self.tracks[track_id].push(frame, [X[index] for X in features])
+        self.tracks = {track_id: track for track_id, track in self.tracks.items()
+                       if frame - track.last_frame <= self.max_idle_frames}
+
+        ready = [track_id for track_id in detections if self.tracks[track_id].is_full()]
+        if ready:
+            windows, window_frames = zip(*(self.tracks[track_id].window() for track_id in ready))
+            errors = self.score_windows([np.stack(X) for X in zip(*windows)])
+            for track_id, track_frames, track_errors in zip(ready, window_frames, errors):
+                for scored_frame, error in zip(track_frames[self.scored_positions], track_errors):
+                    # the window of a track that missed detections reaches back to frames that were already scored
+                    if scored_frame < self.next_frame:
+                        continue
+                    accumulated = self.errors.setdefault(scored_frame, {}).setdefault(track_id, [0., 0])
+                    accumulated[0] += error
+                    accumulated[1] += 1
+
+        return self._emit(frame - self.latency)
+
+    def flush(self):
+        """Score the frames still waiting for later windows, at the end of the stream."""
+        if self.last_frame is None:
+            return []
+        return self._emit(self.last_frame)
+
+    @torch.no_grad()
+    def score_windows(self, features):
+        """
+        Errors of the scored positions of N windows, given as their stacked (N, T, dim) global, local and out features,
+        as a (N, len(scored)) array.
+        """
+        num_windows = len(features[0])
+        batch_size = self.max_batch_size or num_windows
+        errors = []
+        for start in range(0, num_windows, batch_size):
+            batch = [torch.from_numpy(X[start:start + batch_size]).to(self.device) for X in features]
+            with autocast(self.device, self.precision):
+                pred, target = self.model(batch, self.setting, foreval=True)
+            errors.append(compute_rnn_ae_reconstruction_errors(target[-1].float().cpu().numpy(),
+                                                               pred[-1].float().cpu().numpy(), 'mse'))
+
+        return np.concatenate(errors)[:, self.scored_positions]
+
+    def _emit(self, last_frame):
+        scores = []
+        for frame in range(self.next_frame, last_frame + 1):
+            frame_errors = self.errors.pop(frame, {})
+            score = max((total / count for total, count in frame_errors.values()), default=0.)
+            scores.append((frame, float(score)))
+        self.next_frame = max(self.next_frame, last_frame + 1)
+
+        return scores
+
+
+def replay_detections(trajectories_path, video_id):
+    """Group the skeletons of the trajectories of `video_id` in a camera directory by frame, in frame order."""
+    detections = {}
+    for trajectory_id, trajectory in load_trajectories(trajectories_path).items():
+        if trajectory_id.split('_')[0] != video_id:
+            continue
+        for frame, keypoints in zip(trajectory.frames.astype(np.int64), trajectory.coordinates):
+            detections.setdefault(frame, {})[trajectory_id] = keypoints
+
+    return [(frame, detections[frame]) for frame in sorted(detections)]
+
+
+def main(args):
+    video_resolution = [int(dim) for dim in args.video_resolution.split('x')]
+    device = torch.device(args.gpu_id if args.gpu_id != -1 else 'cpu')
+    scorer = StreamingScorer.from_checkpoint(args.chkp, video_resolution, device=device, setting=args.setting,
+                                             precision=args.precision, max_batch_size=args.max_batch_size)
+
+    tick_times = []
+    output = open(args.output, 'w') if args.output else sys.stdout
+    for frame, detections in replay_detections(args.trajectories, args.video):
+        start = time.perf_counter()
+        scores = scorer.update(frame, detections)
+        tick_times.append(time.perf_counter() - start)
+        for scored_frame, score in scores:
+            output.write(f'{scored_frame},{score}\n')
+    for scored_frame, score in scorer.flush():
+        output.write(f'{scored_frame},{score}\n')
+    if args.output:
+        output.close()
+
+    tick_times = np.array(tick_times) * 1000
+    print(f'{len(tick_times)} frames, latency of {scorer.latency} frames, time per frame: '
+          f'mean {tick_times.mean():.1f} ms | p99 {np.percentile(tick_times, 99):.1f} ms | max {tick_times.max():.1f} ms')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Score the frames of a video online, replaying its skeleton trajectories frame '
+                                     'by frame.')
+
+    parser.add_argument('--chkp', type=str, required=True, help='Checkpoint saved by run.py')
+    parser.add_argument('--trajectories', type=str, required=True,
+                        help='Camera directory with the csv skeleton trajectories of its videos')
+    parser.add_argument('--video', type=str, required=True, help='Id of the video to replay, e.g. 0014')
+    parser.add_argument('--video_resolution', default='856x480', type=str, help='Resolution of the video, as WxH')
+    parser.add_argument('--setting', default='future', choices=['past', 'present', 'future'])
+    parser.add_argument('--gpu_id', default=-1, type=int, help='Which GPU to use. -1 for cpu')
+    parser.add_argument('--precision', default='fp32', choices=list(PRECISIONS))
+    parser.add_argument('--max_batch_size', default=None, type=int,
+                        help='Maximum number of track windows per forward pass. By default all of them')
+    parser.add_argument('--output', type=str, default=None,
+                        help='csv file to write the frame,score lines to. By default they are printed')
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+import torch
+
+from export import ExportedTrajREC, example_inputs, export_model
+from models.trajrec import trajrec_tiny
+from utils import batch_inference
+
+
+@pytest.fixture(scope='module')
+def model():
+    torch.manual_seed(0)
+    return trajrec_tiny(input_length=12, prediction_length=6, global_input_dim=4, local_input_dim=34).eval()
+
+
+@pytest.mark.parametrize('format', ['torchscript', 'onnx'])
+@pytest.mark.parametrize('setting', ['past', 'present', 'future'])
+def test_exported_model_matches_eager_model(model, setting, format, tmp_path):
+    if format == 'onnx':
+        pytest.importorskip('onnxruntime')
+    path = str(tmp_path / f'trajrec_{setting}.{"onnx" if format == "onnx" else "pt"}')
+    export_model(model, setting, path, format=format)
+
+    # a batch size other than the one traced with, with the zero padding of missing keypoints
+    x = [X.numpy() for X in example_inputs(model, batch_size=7)]
+    x[1][0, :3] = 0.
+    with torch.no_grad():
+        expected = batch_inference(model, x, setting=setting)
+    exported = ExportedTrajREC(path)(x)
+
+    for output, expected_output in zip(exported[0] + exported[1], expected[0] + expected[1]):
+        assert output.shape == expected_output.shape
+        np.testing.assert_allclose(output, expected_output, rtol=1e-4, atol=1e-5)
@@ -0,0 +1,28 @@
+import numpy as np
+import torch
+
+from models.trajrec import trajrec_tiny
+from streaming import StreamingScorer
+from trajectories import extract_coordinate_features, scale_trajectories
+
+VIDEO_RESOLUTION = [856, 480]
+
+
+def test_track_with_gap_emits_every_frame_once():
+    torch.manual_seed(0)
+    model = trajrec_tiny(input_length=12, prediction_length=6, global_input_dim=4, local_input_dim=34).eval()
+    rng = np.random.default_rng(0)
+    skeletons = rng.uniform([100, 100], [700, 400], size=(64, 17, 2)).reshape(64, 34).astype(np.float32)
+    scalers = [scale_trajectories(X)[1] for X in extract_coordinate_features(skeletons, video_resolution=VIDEO_RESOLUTION)]
+    scorer = StreamingScorer(model, *scalers, VIDEO_RESOLUTION, setting='future', max_idle_frames=100)
+
+    # the track is lost for frames 20 to 24, so its later windows reach frames that were already scored
+    frames = [*range(20), *range(25, 60)]
+    emitted = []
+    for frame in frames:
+        emitted += scorer.update(frame, {'track': skeletons[frame]})
+        assert all(scored_frame >= scorer.next_frame for scored_frame in scorer.errors)
+    emitted += scorer.flush()
+
+    assert [frame for frame, _ in emitted] == list(range(60))
+    assert not scorer.errors
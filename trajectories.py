@@ -1,12 +1,22 @@
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import glob
+import itertools
+import json
+import math
 import os
+import shutil
 import numpy as np
 import pandas as pd
 from sklearn.preprocessing import quantile_transform, MinMaxScaler, RobustScaler
 
-from utils import compute_bounding_box, numpy_mse
+from utils import compute_bounding_boxes, directory_fingerprint, group_mean_per_frame, numpy_mse
 import cv2
 
+PACKED_TRAJECTORIES_DIR = 'packed_trajectories'
+PACKED_TRAJECTORIES_ARRAYS = ('frames', 'coordinates', 'offsets', 'ids')
+PACKED_TRAJECTORIES_META = 'meta.json'
+
 
 class StdScaler:
     def __init__(self, stds=3):
@@ -45,15 +55,18 @@ class Trajectory:
     def __len__(self):
         return len(self.frames)
     
-    def use_global_features(self, video_resolution, extract_delta=False, use_first_step_as_reference=False):
+    def use_global_features(self, video_resolution, extract_delta=False, use_first_step_as_reference=False,
+                            bounding_boxes=None):
         self.coordinates = self._extract_global_features(video_resolution=video_resolution, extract_delta=extract_delta,
-                                                         use_first_step_as_reference=use_first_step_as_reference)
+                                                         use_first_step_as_reference=use_first_step_as_reference,
+                                                         bounding_boxes=bounding_boxes)
     
-    def _extract_global_features(self, video_resolution, extract_delta=False, use_first_step_as_reference=False):
-        bounding_boxes = np.apply_along_axis(compute_bounding_box, axis=1, arr=self.coordinates,
-                                             video_resolution=video_resolution)
-        bbs_measures = np.apply_along_axis(self._extract_bounding_box_measurements, axis=1, arr=bounding_boxes)
-        bbs_centre = np.apply_along_axis(self._extract_bounding_box_centre, axis=1, arr=bounding_boxes)
+    def _extract_global_features(self, video_resolution, extract_delta=False, use_first_step_as_reference=False,
+                                 bounding_boxes=None):
+        if bounding_boxes is None:
+            bounding_boxes = compute_bounding_boxes(self.coordinates, video_resolution=video_resolution)
+        bbs_measures = self._extract_bounding_box_measurements(bounding_boxes)
+        bbs_centre = self._extract_bounding_box_centre(bounding_boxes)
         if extract_delta:
             bbs_delta = np.vstack((np.full((1, 2), fill_value=1e-7), np.diff(bbs_centre, axis=0)))
 
@@ -70,35 +83,42 @@ class Trajectory:
 
     @staticmethod
     def _extract_bounding_box_centre(bb):
-        x = (bb[0] + bb[1]) / 2
-        y = (bb[2] + bb[3]) / 2
+        x = (bb[..., 0] + bb[..., 1]) / 2
+        y = (bb[..., 2] + bb[..., 3]) / 2
 
-        return np.array([x, y], dtype=np.float32)
+        return np.stack((x, y), axis=-1).astype(np.float32)
 
     @staticmethod
     def _extract_bounding_box_measurements(bb):
-        width = bb[1] - bb[0]
-        height = bb[3] - bb[2]
+        width = bb[..., 1] - bb[..., 0]
+        height = bb[..., 3] - bb[..., 2]
 
-        return np.array([width, height], dtype=np.float32)
+        return np.stack((width, height), axis=-1).astype(np.float32)
 
     def change_coordinate_system(self, video_resolution, coordinate_system='global', invert=False):
+        self.coordinates = self.transform_coordinates(self.coordinates, video_resolution=video_resolution,
+                                                      coordinate_system=coordinate_system, invert=invert)
+
+    @staticmethod
+    def transform_coordinates(coordinates, video_resolution, coordinate_system='global', invert=False):
+        """
+        Change the coordinate system of a (T, 2K) array of image coordinates, one skeleton per row. Rows are
+        independent, so the array may hold the frames of many trajectories stacked together.
+        """
         if invert:
             if coordinate_system == 'global':
-                self.coordinates = self._from_global_to_image(self.coordinates, video_resolution=video_resolution)
+                return Trajectory._from_global_to_image(coordinates, video_resolution=video_resolution)
             else:
                 raise ValueError('Unknown coordinate system. Only global is available for inversion.')
         else:
             if coordinate_system == 'global':
-                self.coordinates = self._from_image_to_global(self.coordinates, video_resolution=video_resolution)
+                return Trajectory._from_image_to_global(coordinates, video_resolution=video_resolution)
             elif coordinate_system == 'bounding_box_top_left':
-                self.coordinates = self._from_image_to_bounding_box(self.coordinates,
-                                                                    video_resolution=video_resolution,
-                                                                    location='top_left')
+                return Trajectory._from_image_to_bounding_box(coordinates, video_resolution=video_resolution,
+                                                              location='top_left')
             elif coordinate_system == 'bounding_box_centre':
-                self.coordinates = self._from_image_to_bounding_box(self.coordinates,
-                                                                    video_resolution=video_resolution,
-                                                                    location='centre')
+                return Trajectory._from_image_to_bounding_box(coordinates, video_resolution=video_resolution,
+                                                              location='centre')
             else:
                 raise ValueError('Unknown coordinate system. Please select one of: global, bounding_box_top_left, or '
                                  'bounding_box_centre.')
@@ -131,41 +151,45 @@ class Trajectory:
         return coordinates
 
     @staticmethod
-    def _from_image_to_top_left_bounding_box(coordinates, video_resolution):
-        for idx, kps in enumerate(coordinates):
-            if any(kps):
-                left, right, top, bottom = compute_bounding_box(kps, video_resolution=video_resolution)
-                xs, ys = np.hsplit(kps.reshape(-1, 2), indices_or_sections=2)
-                xs, ys = np.where(xs == 0.0, float(left), xs), np.where(ys == 0.0, float(top), ys)
-                xs, ys = (xs - left) / (right - left), (ys - top) / (bottom - top)
-                kps = np.hstack((xs, ys)).ravel()
+    def _split_keypoints(coordinates, video_resolution, bounding_boxes=None):
+        """
+        Bounding boxes of every row and the x and y keypoints as (T, K) arrays. The box values are cast to the dtype
+        of the coordinates before being combined with them, as the Python scalars of the per-frame version were.
+        """
+        if bounding_boxes is None:
+            bounding_boxes = compute_bounding_boxes(coordinates, video_resolution=video_resolution)
+        keypoints = coordinates.reshape(len(coordinates), -1, 2)
 
-            coordinates[idx] = kps
-
-        return coordinates
+        return bounding_boxes, keypoints[..., 0], keypoints[..., 1]
 
     @staticmethod
-    def _from_image_to_centre_bounding_box(coordinates, video_resolution):
-        # TODO: Better implementation
-        # coordinates = np.where(coordinates == 0, np.nan, coordinates)
-        # bounding_boxes = np.apply_along_axis(compute_bounding_box, axis=1, arr=coordinates,
-        #                                      video_resolution=video_resolution)
-        # centre_x = (bounding_boxes[:, 0] + bounding_boxes[:, 1]) / 2
-        # centre_y = (bounding_boxes[:, 2] + bounding_boxes[:, 3]) / 2
-        for idx, kps in enumerate(coordinates):
-            if any(kps):
-                left, right, top, bottom = compute_bounding_box(kps, video_resolution=video_resolution)
-                centre_x, centre_y = (left + right) / 2, (top + bottom) / 2
-                xs, ys = np.hsplit(kps.reshape(-1, 2), indices_or_sections=2)
-                xs, ys = np.where(xs == 0.0, centre_x, xs) - centre_x, np.where(ys == 0.0, centre_y, ys) - centre_y
-                left, right, top, bottom = left - centre_x, right - centre_x, top - centre_y, bottom - centre_y
-                width, height = right - left, bottom - top
-                xs, ys = xs / (width+0.0001), ys / (height+0.0001)
-                kps = np.hstack((xs, ys)).ravel()
-
-            coordinates[idx] = kps
+    def _from_image_to_top_left_bounding_box(coordinates, video_resolution, bounding_boxes=None):
+        dtype = coordinates.dtype
+        bounding_boxes, xs, ys = Trajectory._split_keypoints(coordinates, video_resolution=video_resolution,
+                                                             bounding_boxes=bounding_boxes)
+        left, right, top, bottom = (bounding_boxes[:, [idx]] for idx in range(4))
+        xs, ys = np.where(xs == 0.0, left.astype(dtype), xs), np.where(ys == 0.0, top.astype(dtype), ys)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            xs, ys = (xs - left.astype(dtype)) / (right - left).astype(dtype), \
+                (ys - top.astype(dtype)) / (bottom - top).astype(dtype)
+
+        # Frames without any keypoint are left untouched.
+        has_keypoints = np.any(coordinates, axis=1, keepdims=True)
+        return np.where(has_keypoints, np.stack((xs, ys), axis=-1).reshape(coordinates.shape), coordinates)
 
-        return coordinates
+    @staticmethod
+    def _from_image_to_centre_bounding_box(coordinates, video_resolution, bounding_boxes=None):
+        dtype = coordinates.dtype
+        bounding_boxes, xs, ys = Trajectory._split_keypoints(coordinates, video_resolution=video_resolution,
+                                                             bounding_boxes=bounding_boxes)
+        left, right, top, bottom = (bounding_boxes[:, [idx]] for idx in range(4))
+        # Frames without any keypoint have an empty box centred at zero, so they come out as zeros again.
+        centre_x, centre_y = ((left + right) / 2).astype(dtype), ((top + bottom) / 2).astype(dtype)
+        xs, ys = np.where(xs == 0.0, centre_x, xs) - centre_x, np.where(ys == 0.0, centre_y, ys) - centre_y
+        width, height = right - left, bottom - top
+        xs, ys = xs / (width + 0.0001).astype(dtype), ys / (height + 0.0001).astype(dtype)
+
+        return np.stack((xs, ys), axis=-1).reshape(coordinates.shape)
 
     def is_short(self, input_length, input_gap, pred_length=0):
         min_trajectory_length = input_length + input_gap * (input_length - 1) + pred_length
@@ -198,18 +222,49 @@ class Trajectory:
             consecutive_missing_steps = 0
 
 
-def load_trajectories(trajectories_path, load_ordered=False, elsec_data=False):
+def read_trajectory_file(trajectory_file_path, elsec_data=False):
+    if elsec_data:
+        trajectory_df = pd.read_csv(trajectory_file_path)
+        return trajectory_df.iloc[:, :-1].to_numpy().astype(np.float32)
+
+    return np.loadtxt(trajectory_file_path, dtype=np.float32, delimiter=',', ndmin=2)
+
+
+def _read_trajectory_files(trajectories_path, csv_file_names, elsec_data=False):
+    return [read_trajectory_file(os.path.join(trajectories_path, csv_file_name), elsec_data=elsec_data)
+            for csv_file_name in csv_file_names]
+
+
+def read_trajectory_files(trajectories_path, csv_file_names, elsec_data=False, num_workers=0, chunks_per_worker=4):
+    """
+    Parse the csv files, in the given order. With `num_workers` > 1 the files are split into chunks that are parsed by a
+    pool of processes; the results are gathered back in the original order.
+    """
+    if num_workers <= 1 or len(csv_file_names) <= 1:
+        return _read_trajectory_files(trajectories_path, csv_file_names, elsec_data=elsec_data)
+
+    chunk_size = max(1, math.ceil(len(csv_file_names) / (num_workers * chunks_per_worker)))
+    chunks = [csv_file_names[idx:idx + chunk_size] for idx in range(0, len(csv_file_names), chunk_size)]
+    read_chunk = partial(_read_trajectory_files, trajectories_path, elsec_data=elsec_data)
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        return list(itertools.chain.from_iterable(executor.map(read_chunk, chunks)))
+
+
+def load_trajectories(trajectories_path, load_ordered=False, elsec_data=False, use_packed=True, num_workers=0):
+    """
+    The trajectories of the csv files under `trajectories_path`, read from its packed store if it has an up to date
+    one (whose trajectories are always ordered).
+    """
+    if use_packed and has_packed_trajectories(trajectories_path, elsec_data=elsec_data):
+        return load_packed_trajectories(os.path.join(trajectories_path, PACKED_TRAJECTORIES_DIR))
+
     trajectories = {}
     csv_files = [f for f in glob.iglob('**/*.csv', root_dir=trajectories_path, recursive=True)]
     if load_ordered:
         csv_files = sorted(csv_files)
-    for csv_file_name in csv_files:
-        trajectory_file_path = os.path.join(trajectories_path, csv_file_name)
-        if elsec_data:
-            trajectory_df = pd.read_csv(trajectory_file_path)
-            trajectory = trajectory_df.iloc[:, :-1].to_numpy().astype(np.float32)
-        else:
-            trajectory = np.loadtxt(trajectory_file_path, dtype=np.float32, delimiter=',', ndmin=2)
+    csv_trajectories = read_trajectory_files(trajectories_path, csv_files, elsec_data=elsec_data,
+                                             num_workers=num_workers)
+    for csv_file_name, trajectory in zip(csv_files, csv_trajectories):
         trajectory_frames, trajectory_coordinates = trajectory[:, 0].astype(np.int64), trajectory[:, 1:]
         trajectory_id = os.path.splitext(csv_file_name)[0].replace(os.sep, '_')
 
@@ -249,6 +304,80 @@ def load_trajectories(trajectories_path, load_ordered=False, elsec_data=False):
     return trajectories
 
 
+def _csv_fingerprint(trajectories_path):
+    return directory_fingerprint(trajectories_path,
+                                 exclude=(PACKED_TRAJECTORIES_DIR, PACKED_TRAJECTORIES_DIR + '.tmp'))
+
+
+def has_packed_trajectories(trajectories_path, elsec_data=False):
+    """
+    Whether `trajectories_path` has a packed store of its csv files, in the same format, written after their last
+    change. A store of csv files that were edited, added or removed since is stale and ignored.
+    """
+    store_path = os.path.join(trajectories_path, PACKED_TRAJECTORIES_DIR)
+    if not all(os.path.isfile(os.path.join(store_path, name + '.npy')) for name in PACKED_TRAJECTORIES_ARRAYS):
+        return False
+    try:
+        with open(os.path.join(store_path, PACKED_TRAJECTORIES_META)) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return False
+
+    return meta.get('elsec_data') == elsec_data and meta.get('fingerprint') == _csv_fingerprint(trajectories_path)
+
+
+def pack_trajectories(trajectories_path, store_path=None, elsec_data=False):
+    """
+    Pack all the csv trajectories under `trajectories_path` into a single contiguous store: the frames of every
+    trajectory back to back, their coordinates as one float32 matrix, the offset of each trajectory in those arrays and
+    the table of trajectory ids. By default the store is written inside `trajectories_path`, where `load_trajectories`
+    picks it up instead of the csv files for as long as they do not change.
+    """
+    if store_path is None:
+        store_path = os.path.join(trajectories_path, PACKED_TRAJECTORIES_DIR)
+    fingerprint = _csv_fingerprint(trajectories_path)
+    trajectories = load_trajectories(trajectories_path, load_ordered=True, elsec_data=elsec_data, use_packed=False)
+
+    ids = np.array(list(trajectories.keys()))
+    lengths = [len(trajectory) for trajectory in trajectories.values()]
+    offsets = np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)
+    frames = np.concatenate([trajectory.frames for trajectory in trajectories.values()]).astype(np.int64)
+    coordinates = np.vstack([trajectory.coordinates for trajectory in trajectories.values()]).astype(np.float32)
+
+    # Write next to the final location and swap it in, so an interrupted run never leaves a half-written store behind.
+    tmp_store_path = store_path + '.tmp'
+    shutil.rmtree(tmp_store_path, ignore_errors=True)
+    os.makedirs(tmp_store_path)
+    for name, array in zip(PACKED_TRAJECTORIES_ARRAYS, (frames, coordinates, offsets, ids)):
+        np.save(os.path.join(tmp_store_path, name + '.npy'), array)
+    with open(os.path.join(tmp_store_path, PACKED_TRAJECTORIES_META), 'w') as f:
+        json.dump({'fingerprint': fingerprint, 'elsec_data': elsec_data}, f)
+    shutil.rmtree(store_path, ignore_errors=True)
+    os.rename(tmp_store_path, store_path)
+
+    return store_path
+
+
+def load_packed_trajectories(store_path, mmap_mode='c'):
+    """
+    Open a store written by `pack_trajectories`. The arrays are memory mapped (copy-on-write by default, so in-place
+    changes to the coordinates never reach the file) and every `Trajectory` holds views into them.
+    """
+    frames, coordinates, offsets, ids = (np.load(os.path.join(store_path, name + '.npy'), mmap_mode=mmap_mode)
+                                         for name in PACKED_TRAJECTORIES_ARRAYS)
+    frames, coordinates = frames.view(np.ndarray), coordinates.view(np.ndarray)
+
+    trajectories = {}
+    for idx, trajectory_id in enumerate(ids):
+        trajectory_id = str(trajectory_id)
+        start, stop = offsets[idx], offsets[idx + 1]
+        trajectories[trajectory_id] = Trajectory(trajectory_id=trajectory_id,
+                                                 frames=frames[start:stop],
+                                                 coordinates=coordinates[start:stop])
+
+    return trajectories
+
+
 # def compute_ae_reconstruction_errors(X, reconstructed_X, loss):
 #     loss_fn = {'log_loss': binary_crossentropy, 'mae': mean_absolute_error, 'mse': mean_squared_error}[loss]
 #     return loss_fn(X, reconstructed_X)
@@ -275,44 +404,61 @@ def load_anomaly_masks(anomaly_masks_path):
 
 def assemble_ground_truth_and_reconstructions(anomaly_masks, trajectory_ids,
                                               reconstruction_frames, reconstruction_errors,
-                                              return_video_ids=False, return_grouped_scores=False, elsec_data=False):
-    y_true, y_hat = {}, {}
+                                              return_video_ids=False, return_grouped_scores=False, elsec_data=False,
+                                              trajectory_names=None, trajectory_videos=None, video_names=None):
+    """
+    When `trajectory_names` is given, `trajectory_ids` holds integer codes into it instead of the
+    `<video id>_<skeleton id>` strings themselves. When `trajectory_videos` is given too, the video of every trajectory
+    is looked up from its code, an index into the `video_names` table, instead of being parsed from its name.
+    """
+    y_true = {}
     if elsec_data:
         y_true_list = []
         for full_id in sorted(anomaly_masks.keys()):
             y_true_list.append(anomaly_masks[full_id])
         y_true[0] = np.array(y_true_list)
-        y_hat[0] = np.zeros_like(y_true[0], dtype=np.float32)
     else:
         for full_id in anomaly_masks.keys():
             _, video_id = full_id.split('_')
             y_true[video_id] = anomaly_masks[full_id].astype(np.int32)
-            y_hat[video_id] = np.zeros_like(y_true[video_id], dtype=np.float32)
-            # print(y_hat[video_id])
 
-    unique_ids = np.unique(trajectory_ids)
+    # All the videos share one score vector, each starting at its own offset, so that every (video, frame, score)
+    # triplet is written with a single scatter-max.
+    sorted_video_ids = sorted(y_true.keys())
+    video_lengths = np.array([len(y_true[video_id]) for video_id in sorted_video_ids])
+    video_offsets = np.cumsum(video_lengths) - video_lengths
+    y_true_ = np.concatenate([y_true[video_id] for video_id in sorted_video_ids])
+    y_hat_ = np.zeros_like(y_true_, dtype=np.float32)
+
     if elsec_data:
-            for trajectory_id in unique_ids:
-                indices = trajectory_ids == trajectory_id
-                frames = reconstruction_frames[indices]
-                y_hat[0][frames] = np.maximum(y_hat[0][frames], reconstruction_errors[indices])
+        positions = reconstruction_frames
+        frame_limits = len(y_hat_)
     else:
-        for trajectory_id in unique_ids:
-            video_id, _ = trajectory_id.split('_')
-            indices = trajectory_ids == trajectory_id
-            frames = reconstruction_frames[indices]
-            y_hat[video_id][frames] = np.maximum(y_hat[video_id][frames], reconstruction_errors[indices])
-
-    y_true_, y_hat_, video_ids = [], [], []
-
-    for video_id in sorted(y_true.keys()):
-        y_true_.append(y_true[video_id])
-        y_hat_.append(y_hat[video_id])
-        video_ids.extend([video_id] * len(y_true_[-1]))
-
-    y_true_, y_hat_ = np.concatenate(y_true_), np.concatenate(y_hat_)
+        unique_ids, inverse = np.unique(trajectory_ids, return_inverse=True)
+        video_indices = {video_id: index for index, video_id in enumerate(sorted_video_ids)}
+        if trajectory_videos is not None:
+            video_name_indices = np.array([video_indices[video_id] for video_id in video_names], dtype=np.int64)
+            trajectory_video_indices = video_name_indices[trajectory_videos[unique_ids]]
+        else:
+            unique_names = unique_ids if trajectory_names is None else trajectory_names[unique_ids]
+            trajectory_video_indices = np.array([video_indices[name.split('_')[0]] for name in unique_names],
+                                                dtype=np.int64)
+        video_of_frame = trajectory_video_indices[inverse.reshape(-1)]
+        positions = video_offsets[video_of_frame] + reconstruction_frames
+        frame_limits = video_lengths[video_of_frame]
+    # A frame outside its video would be written into the scores of a neighbouring video.
+    frame_limits = np.broadcast_to(frame_limits, np.shape(reconstruction_frames))
+    out_of_bounds = (reconstruction_frames < 0) | (reconstruction_frames >= frame_limits)
+    if out_of_bounds.any():
+        index = np.flatnonzero(out_of_bounds)[0]
+        raise IndexError(f'{out_of_bounds.sum()} reconstructed frames are outside their video, e.g. frame '
+                         f'{reconstruction_frames[index]} of a video of {frame_limits[index]} frames')
+    np.maximum.at(y_hat_, positions, reconstruction_errors)
+
+    y_hat = dict(zip(sorted_video_ids, np.split(y_hat_, video_offsets[1:])))
 
     if return_video_ids:
+        video_ids = [video_id for video_id, length in zip(sorted_video_ids, video_lengths) for _ in range(length)]
         return y_true_, y_hat_, video_ids
     if return_grouped_scores:
         return y_true_, y_hat_, y_true, y_hat
@@ -333,13 +479,47 @@ def input_trajectories_missing_steps(trajectories):
 
     return trajectories
 
+def concatenate_coordinates(trajectories):
+    """Stack the coordinates of all trajectories, returning the indices at which to split them back apart."""
+    lengths = [len(trajectory.coordinates) for trajectory in trajectories.values()]
+    split_indices = np.cumsum(lengths)[:-1]
+
+    return np.vstack([trajectory.coordinates for trajectory in trajectories.values()]), split_indices
+
+
 def extract_global_features(trajectories, video_resolution, extract_delta=False, use_first_step_as_reference=False):
-    for trajectory in trajectories.values():
+    if not trajectories:
+        return trajectories
+
+    coordinates, split_indices = concatenate_coordinates(trajectories)
+    bounding_boxes = compute_bounding_boxes(coordinates, video_resolution=video_resolution)
+    for trajectory, trajectory_bounding_boxes in zip(trajectories.values(), np.split(bounding_boxes, split_indices)):
         trajectory.use_global_features(video_resolution=video_resolution, extract_delta=extract_delta,
-                                       use_first_step_as_reference=use_first_step_as_reference)
+                                       use_first_step_as_reference=use_first_step_as_reference,
+                                       bounding_boxes=trajectory_bounding_boxes)
 
     return trajectories
 
+def extract_coordinate_features(coordinates, video_resolution, reconstruct_original_data=True):
+    """
+    The model input features of a (T, 34) array of skeletons in image coordinates, in a single pass: the global
+    bounding box features (centre and size, normalised by the resolution), the keypoints relative to the bounding box
+    centre and, if `reconstruct_original_data`, the keypoints normalised by the resolution. The bounding boxes are
+    computed once for all of them and `coordinates` is left untouched. Gives the same values as running
+    `extract_global_features` and `change_coordinate_system` on copies of the trajectories.
+    """
+    bounding_boxes = compute_bounding_boxes(coordinates, video_resolution=video_resolution)
+    global_features = np.hstack((Trajectory._extract_bounding_box_centre(bounding_boxes),
+                                 Trajectory._extract_bounding_box_measurements(bounding_boxes)))
+
+    features = [Trajectory._from_image_to_global(global_features, video_resolution=video_resolution),
+                Trajectory._from_image_to_centre_bounding_box(coordinates, video_resolution=video_resolution,
+                                                              bounding_boxes=bounding_boxes)]
+    if reconstruct_original_data:
+        features.append(Trajectory._from_image_to_global(coordinates, video_resolution=video_resolution))
+
+    return features
+
 def scale_trajectories(X, scaler=None, strategy='zero_one'):
     original_shape = X.shape
     input_dim = original_shape[-1]
@@ -412,8 +592,15 @@ def change_coordinate_system(trajectories, video_resolution, coordinate_system='
         'global': normalize pixel coordinates to the range [0, 1] using `video_resolution`.
         'bounding_box_centre': local pose, normalized to bounding box.
     """
-    for trajectory in trajectories.values():
-        trajectory.change_coordinate_system(video_resolution, coordinate_system=coordinate_system, invert=invert)
+    if not trajectories:
+        return trajectories
+
+    # Transform the frames of all trajectories as one batch and hand each trajectory its slice back.
+    coordinates, split_indices = concatenate_coordinates(trajectories)
+    coordinates = Trajectory.transform_coordinates(coordinates, video_resolution=video_resolution,
+                                                   coordinate_system=coordinate_system, invert=invert)
+    for trajectory, trajectory_coordinates in zip(trajectories.values(), np.split(coordinates, split_indices)):
+        trajectory.coordinates = trajectory_coordinates
 
     return trajectories
 
@@ -567,35 +754,7 @@ def summarise_reconstruction_errors(reconstruction_errors, frames, trajectory_id
     Simplify skeleton trajectory prediction errors by averaging errors of overlapping predictions.
     The result will still have multiple scores per frame numbers when different trajectories (persons) overlap.
     """
-    unique_ids = np.unique(trajectory_ids)
-    all_trajectory_ids, all_summarised_frames, all_summarised_errors = [], [], []
-    for trajectory_id in unique_ids:
-        if elsec_data ==True:
-            tst = 1
-        else:
-            mask = trajectory_ids == trajectory_id
-        current_frames = frames[mask]
-        current_errors = reconstruction_errors[mask]
-        summarised_frames, summarised_errors = summarise_reconstruction_errors_per_frame(current_errors, current_frames)
-        all_summarised_frames.append(summarised_frames)
-        all_summarised_errors.append(summarised_errors)
-        all_trajectory_ids.append([trajectory_id] * len(summarised_frames))
-
-    all_trajectory_ids = np.concatenate(all_trajectory_ids)
-    all_summarised_frames = np.concatenate(all_summarised_frames)
-    all_summarised_errors = np.concatenate(all_summarised_errors)
-
-    return all_trajectory_ids, all_summarised_frames, all_summarised_errors
-
-
-def summarise_reconstruction_errors_per_frame(errors, frames):
-    unique_frames = np.unique(frames)
-    unique_errors = np.empty(unique_frames.shape, dtype=np.float32)
-    for idx, frame in enumerate(unique_frames):
-        mask = frames == frame
-        unique_errors[idx] = np.mean(errors[mask])
-
-    return unique_frames, unique_errors
+    return group_mean_per_frame(trajectory_ids.reshape(-1), frames.reshape(-1), reconstruction_errors.reshape(-1))
 
 
 def retrieve_future_skeletons(trajectories_ids, X, pred_length):
@@ -625,26 +784,25 @@ def retrieve_future_skeletons(trajectories_ids, X, pred_length):
 
 
 def discard_information_from_padded_frames(pred_ids, pred_frames, pred_errors, pred_length):
+    """
+    Drop the last `pred_length` examples of every trajectory, grouping the examples by trajectory in order of first
+    appearance.
+    """
     id_per_example = pred_ids[:, 0]
-    indices = np.unique(id_per_example, return_index=True)[1]
-    unique_ids = [id_per_example[idx] for idx in sorted(indices)]
-
-    all_ids, all_frames, all_errors = [], [], []
-    for unique_id in unique_ids:
-        current_ids = unique_id == id_per_example
-        actual_ids = pred_ids[current_ids][:-pred_length]
-        actual_frames = pred_frames[current_ids][:-pred_length]
-        actual_errors = pred_errors[current_ids][:-pred_length]
-
-        all_ids.append(actual_ids)
-        all_frames.append(actual_frames)
-        all_errors.append(actual_errors)
-
-    all_ids = np.vstack(all_ids)
-    all_frames = np.vstack(all_frames)
-    all_errors = np.vstack(all_errors)
-
-    return all_ids, all_frames, all_errors
+    _, first_indices, inverse, counts = np.unique(id_per_example, return_index=True, return_inverse=True,
+                                                  return_counts=True)
+    inverse = inverse.reshape(-1)
+    appearance_order = np.argsort(first_indices)
+    appearance_rank = np.empty_like(appearance_order)
+    appearance_rank[appearance_order] = np.arange(len(appearance_order))
+    order = np.argsort(appearance_rank[inverse], kind='stable')
+
+    # Position of every (reordered) example within its trajectory.
+    ordered_counts = counts[appearance_order]
+    positions = np.arange(len(order)) - np.repeat(np.cumsum(ordered_counts) - ordered_counts, ordered_counts)
+    keep = order[positions < counts[inverse[order]] - pred_length]
+
+    return pred_ids[keep], pred_frames[keep], pred_errors[keep]
 
 
 def compute_num_frames_per_video(anomaly_masks):
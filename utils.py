@@ -1,10 +1,23 @@
+import functools
+import glob
+import inspect
 import joblib
 import os
+import shutil
 import numpy as np
 import torch
 from torch.utils.data import TensorDataset, DataLoader
 
-memory = joblib.Memory(os.environ['HOME'] + '/.cache/TrajREC')
+CACHE_DIR = os.environ['HOME'] + '/.cache/TrajREC'
+
+ARRAY_CACHE_DIR = os.path.join(CACHE_DIR, 'arrays')
+ARRAY_CACHE_VERSION = 2
+ARRAY_CACHE_SIDECAR = 'result.pkl'
+# Size (in bytes) up to which the array cache can grow before its least recently used entries are evicted.
+ARRAY_CACHE_MAX_SIZE = int(os.environ.get('TRAJREC_CACHE_MAX_SIZE', 50 * 1024 ** 3))
+
+# Autocast dtype of every supported precision, full precision running without autocast.
+PRECISIONS = {'fp32': None, 'bf16': torch.bfloat16, 'fp16': torch.float16}
 
 
 class AverageMeter(object):
@@ -34,30 +47,237 @@ def numpy_mse(y_pred, y_true):
 
 
 
+def directory_fingerprint(path, exclude=()):
+    """
+    Hash of the relative paths, sizes and modification times of all the files under `path`, except those in its
+    subdirectories named in `exclude`.
+    """
+    entries = []
+    for root, dir_names, file_names in os.walk(path):
+        if root == path:
+            dir_names[:] = [dir_name for dir_name in dir_names if dir_name not in exclude]
+        dir_names.sort()
+        for file_name in sorted(file_names):
+            file_path = os.path.join(root, file_name)
+            stat = os.stat(file_path)
+            entries.append((os.path.relpath(file_path, path), stat.st_size, stat.st_mtime_ns))
+
+    return joblib.hash(entries)
+
+
+class _CachedArray:
+    """Placeholder for the `index`-th array of a cached result, which is stored in a file of its own."""
+
+    def __init__(self, index):
+        self.index = index
+
+
+class _CachedTrajectories:
+    """
+    Placeholder for a dict of trajectories, whose frames and coordinates are stored back to back in two cached arrays,
+    split at `offsets`. The other attributes of every trajectory (its id and flags) are kept in `attributes`.
+    """
+
+    def __init__(self, trajectory_class, attributes, offsets, frames, coordinates):
+        self.trajectory_class = trajectory_class
+        self.attributes = attributes
+        self.offsets = offsets
+        self.frames = frames
+        self.coordinates = coordinates
+
+
+def _is_trajectory_dict(obj):
+    if type(obj) is not dict or not obj:
+        return False
+    values = list(obj.values())
+    if not all(isinstance(getattr(value, 'frames', None), np.ndarray) and
+               isinstance(getattr(value, 'coordinates', None), np.ndarray) and hasattr(value, '__dict__')
+               for value in values):
+        return False
+    return (len({type(value) for value in values}) == 1 and
+            len({value.coordinates.shape[1:] for value in values}) == 1 and
+            not any(value.frames.dtype.hasobject or value.coordinates.dtype.hasobject for value in values))
+
+
+def _extract_arrays(obj, arrays):
+    if isinstance(obj, np.ndarray) and not obj.dtype.hasobject:
+        arrays.append(obj)
+        return _CachedArray(len(arrays) - 1)
+    if _is_trajectory_dict(obj):
+        values = list(obj.values())
+        lengths = [len(value.frames) for value in values]
+        attributes = {key: {name: attribute for name, attribute in vars(value).items()
+                            if name not in ('frames', 'coordinates')}
+                      for key, value in obj.items()}
+        packed = [np.concatenate(([0], np.cumsum(lengths))).astype(np.int64),
+                  np.concatenate([value.frames for value in values]),
+                  np.concatenate([value.coordinates for value in values])]
+        return _CachedTrajectories(type(values[0]), attributes, *(_extract_arrays(array, arrays) for array in packed))
+    if type(obj) in (list, tuple):
+        return type(obj)(_extract_arrays(item, arrays) for item in obj)
+    if type(obj) is dict:
+        return {key: _extract_arrays(value, arrays) for key, value in obj.items()}
+
+    return obj
+
+
+def _restore_arrays(obj, load_array):
+    if isinstance(obj, _CachedArray):
+        return load_array(obj.index)
+    if isinstance(obj, _CachedTrajectories):
+        offsets, frames, coordinates = (load_array(array.index) for array in (obj.offsets, obj.frames, obj.coordinates))
+        trajectories = {}
+        for (key, attributes), start, stop in zip(obj.attributes.items(), offsets[:-1], offsets[1:]):
+            trajectory = obj.trajectory_class.__new__(obj.trajectory_class)
+            vars(trajectory).update(attributes, frames=frames[start:stop], coordinates=coordinates[start:stop])
+            trajectories[key] = trajectory
+        return trajectories
+    if type(obj) in (list, tuple):
+        return type(obj)(_restore_arrays(item, load_array) for item in obj)
+    if type(obj) is dict:
+        return {key: _restore_arrays(value, load_array) for key, value in obj.items()}
+
+    return obj
+
+
+def save_cached_result(cache_path, result):
+    """
+    Save `result` in the directory `cache_path`: every array in it (also inside lists, tuples and dicts) as a `.npy`
+    file of its own, and the frames and coordinates of every dict of trajectories packed into two of them, the rest
+    pickled in a small sidecar. The directory is written next to its final location and
+    renamed into place, so readers never see a half-written entry; an existing entry is kept as it is.
+    """
+    arrays = []
+    structure = _extract_arrays(result, arrays)
+
+    tmp_cache_path = cache_path + '.tmp%d' % os.getpid()
+    shutil.rmtree(tmp_cache_path, ignore_errors=True)
+    os.makedirs(tmp_cache_path)
+    for idx, array in enumerate(arrays):
+        np.save(os.path.join(tmp_cache_path, 'array%d.npy' % idx), array)
+    joblib.dump(structure, os.path.join(tmp_cache_path, ARRAY_CACHE_SIDECAR))
+    try:
+        os.rename(tmp_cache_path, cache_path)
+    except OSError:
+        # Another process wrote the same entry first.
+        shutil.rmtree(tmp_cache_path, ignore_errors=True)
+
+
+def load_cached_result(cache_path, mmap_mode='c'):
+    """
+    Load a result saved by `save_cached_result`, with its arrays memory mapped (copy-on-write by default, so processes
+    opening the same entry share the page cache). Returns `None` if there is no entry at `cache_path`.
+    """
+    sidecar_path = os.path.join(cache_path, ARRAY_CACHE_SIDECAR)
+    if not os.path.isfile(sidecar_path):
+        return None
+
+    def load_array(idx):
+        return np.load(os.path.join(cache_path, 'array%d.npy' % idx), mmap_mode=mmap_mode).view(np.ndarray)
+
+    return _restore_arrays(joblib.load(sidecar_path), load_array)
+
+
+def evict_cached_results(max_size=ARRAY_CACHE_MAX_SIZE, keep=()):
+    """Delete the least recently used entries of the array cache until all of them take at most `max_size` bytes."""
+    entries = []
+    for cache_path in glob.glob(os.path.join(ARRAY_CACHE_DIR, '*', '*')):
+        if not os.path.isfile(os.path.join(cache_path, ARRAY_CACHE_SIDECAR)):
+            continue
+        size = sum(entry.stat().st_size for entry in os.scandir(cache_path) if entry.is_file())
+        entries.append((os.stat(cache_path).st_mtime, size, cache_path))
+
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, cache_path in sorted(entries):
+        if total_size <= max_size:
+            break
+        if cache_path in keep:
+            continue
+        # Processes that have the arrays memory mapped keep them until they unmap them.
+        shutil.rmtree(cache_path, ignore_errors=True)
+        total_size -= size
+
+
+def array_cache(name, version=1, ignore=(), fingerprint=(), mmap_mode='c'):
+    """
+    Cache the results of the decorated function in `ARRAY_CACHE_DIR/name`, with `save_cached_result`: on a hit the
+    arrays are memory mapped instead of unpickled. The key hashes the cache format, `version` (bump it when the
+    function changes its output) and the arguments not in `ignore`; for the arguments in `fingerprint`, which are
+    directories, the `directory_fingerprint` of their contents is hashed too. Least recently used entries are evicted
+    once the cache grows beyond `ARRAY_CACHE_MAX_SIZE` bytes. As with `joblib.Memory`, the uncached function is
+    available as `.func`.
+    """
+    def decorator(fn):
+        signature = inspect.signature(fn)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            arguments = signature.bind(*args, **kwargs)
+            arguments.apply_defaults()
+            key_arguments = {key: value for key, value in arguments.arguments.items() if key not in ignore}
+            fingerprints = {key: directory_fingerprint(arguments.arguments[key]) for key in fingerprint}
+            key = joblib.hash((ARRAY_CACHE_VERSION, version, key_arguments, fingerprints))
+            cache_path = os.path.join(ARRAY_CACHE_DIR, name, key)
+
+            result = load_cached_result(cache_path, mmap_mode=mmap_mode)
+            if result is not None:
+                # Mark the entry as recently used.
+                os.utime(cache_path)
+                return result
+
+            result = fn(*args, **kwargs)
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            save_cached_result(cache_path, result)
+            evict_cached_results(keep=(cache_path,))
+
+            return result
+
+        wrapper.func = fn
+        return wrapper
+
+    return decorator
+
+
+def autocast(device, precision='fp32'):
+    """
+    Context running the ops of a model on `device` in the given precision (one of `PRECISIONS`).
+    """
+    dtype = PRECISIONS[precision]
+    return torch.autocast(device_type=torch.device(device).type, dtype=dtype, enabled=dtype is not None)
+
+
 @torch.no_grad()
-def batch_inference(model, x, batch_size=None, setting='future'):
+def batch_inference(model, x, batch_size=None, setting='future', precision='fp32'):
+    """
+    When `setting` is a sequence of settings, every batch is evaluated under all of them in a single pass of the model
+    and a list with the `(output, targets)` pair of each setting is returned.
+    """
     if batch_size is None:
         batch_size = len(x[0])
     device = next(model.parameters()).device
     dataset = TensorDataset(*(torch.Tensor(d) for d in x))
     dataloader = DataLoader(dataset, batch_size=batch_size)
-    output = None
-    targets = None
+    settings = [setting] if isinstance(setting, str) else setting
+    results = [[None, None] for _ in settings]
     for batch in dataloader:
         batch = [d.to(device) for d in batch]
-        batch, target = model(batch,setting,foreval=True)
-        if output is None:
-            output = [[] for _ in range(len(batch))]
-        if targets is None:
-            targets = [[] for _ in range(len(target))]
-        for i, tensor in enumerate(batch):
-            output[i].append(tensor.detach().cpu().numpy())
-        for j, targ in enumerate(target):
-            targets[j].append(targ.detach().cpu().numpy())
-    output = [np.concatenate(d) for d in output]
-    targets = [np.concatenate(d) for d in targets]
+        with autocast(device, precision):
+            batch_results = model(batch,setting,foreval=True)
+        if isinstance(setting, str):
+            batch_results = [batch_results]
+        for result, (batch, target) in zip(results, batch_results):
+            if result[0] is None:
+                result[0] = [[] for _ in range(len(batch))]
+            if result[1] is None:
+                result[1] = [[] for _ in range(len(target))]
+            for i, tensor in enumerate(batch):
+                result[0][i].append(tensor.detach().float().cpu().numpy())
+            for j, targ in enumerate(target):
+                result[1][j].append(targ.detach().float().cpu().numpy())
+    results = [([np.concatenate(d) for d in output], [np.concatenate(d) for d in targets])
+               for output, targets in results]
     
-    return output, targets
+    return results[0] if isinstance(setting, str) else results
 
 
 def inverse_scale(X, scaler):
@@ -108,40 +328,66 @@ def compute_bounding_box(keypoints, video_resolution, return_discrete_values=Tru
         return left, right, top, bottom
 
 
-def summarise_reconstruction(reconstructed_X, frames, trajectory_ids):
-    unique_ids = np.unique(trajectory_ids)
-    num_examples, input_length, input_dim = reconstructed_X.shape
-    reconstructed_X = reconstructed_X.reshape(-1, input_dim)
-    frames = frames.reshape(-1)
-    trajectory_ids = trajectory_ids.reshape(-1)
+def compute_bounding_boxes(keypoints, video_resolution, return_discrete_values=True):
+    """
+    Batched `compute_bounding_box`: one (left, right, top, bottom) row per row of `keypoints`, with the same values
+    (including the dtype promotions of the scalar arithmetic) as calling `compute_bounding_box` on every row.
+    """
+    width, height = video_resolution
+    keypoints_reshaped = keypoints.reshape(len(keypoints), -1, 2)
+    x, y = keypoints_reshaped[..., 0], keypoints_reshaped[..., 1]
+    x_missing, y_missing = x == 0.0, y == 0.0
+    valid = ~(np.all(x_missing, axis=1) | np.all(y_missing, axis=1))
+    left, right = np.where(x_missing, np.inf, x).min(axis=1), np.where(x_missing, -np.inf, x).max(axis=1)
+    top, bottom = np.where(y_missing, np.inf, y).min(axis=1), np.where(y_missing, -np.inf, y).max(axis=1)
+    left, right, top, bottom = (np.where(valid, v, 0) for v in (left, right, top, bottom))
+
+    # The scalar version computes the padding of a single box as `0.1 * numpy_scalar`, which promotes differently than
+    # `0.1 * array` does under NumPy < 2. Do the same promotion explicitly.
+    dtype = np.result_type(keypoints.dtype.type(0), 0.1)
+    extra_width, extra_height = 0.1 * (right - left + 1).astype(dtype), 0.1 * (bottom - top + 1).astype(dtype)
+    left, right = np.clip(left - extra_width, 0, width - 1), np.clip(right + extra_width, 0, width - 1)
+    top, bottom = np.clip(top - extra_height, 0, height - 1), np.clip(bottom + extra_height, 0, height - 1)
+
+    bounding_boxes = np.stack((left, right, top, bottom), axis=1)
+    if return_discrete_values:
+        bounding_boxes = np.rint(bounding_boxes).astype(np.int64)
+    bounding_boxes[~valid] = 0
+
+    return bounding_boxes
 
-    all_trajectory_ids, all_summarised_frames, all_summarised_recs = [], [], []
-    for trajectory_id in unique_ids:
-        mask = trajectory_ids == trajectory_id
 
-        current_frames = frames[mask]
-        
-        current_reconstructions = reconstructed_X[mask, :]
-        summarised_frames, summarised_recs = summarise_reconstruction_per_frame(current_reconstructions, current_frames)
-        all_summarised_frames.append(summarised_frames)
-        all_summarised_recs.append(summarised_recs)
-        all_trajectory_ids.append([trajectory_id] * len(summarised_frames))
+def group_mean_per_frame(trajectory_ids, frames, values):
+    """
+    Average the `values` (rows of) that share the same trajectory id and frame. Sorts once by (trajectory id, frame)
+    and sums every run of equal keys with `np.add.reduceat`, returning the ids, frames and means of the groups in that
+    order. The means match those of np.mean up to float rounding: np.mean sums groups of more than 8 values pairwise,
+    so the results are not bit-identical.
+    """
+    unique_ids, id_codes = np.unique(trajectory_ids, return_inverse=True)
+    id_codes = id_codes.reshape(-1)
+    # Stable, so the values of a group are summed in their original order.
+    order = np.lexsort((frames, id_codes))
+    id_codes, frames, values = id_codes[order], frames[order], values[order]
 
-    all_trajectory_ids = np.concatenate(all_trajectory_ids)
-    all_summarised_frames = np.concatenate(all_summarised_frames)
-    all_summarised_recs = np.vstack(all_summarised_recs)
+    is_group_start = np.ones(len(frames), dtype=bool)
+    is_group_start[1:] = (id_codes[1:] != id_codes[:-1]) | (frames[1:] != frames[:-1])
+    group_starts = np.flatnonzero(is_group_start)
+    group_sizes = np.diff(np.append(group_starts, len(frames)))
 
-    return all_trajectory_ids, all_summarised_frames, all_summarised_recs
+    sums = np.add.reduceat(values, group_starts, axis=0) if len(frames) else values[:0]
+    means = sums / group_sizes.reshape((-1,) + (1,) * (values.ndim - 1)).astype(sums.dtype)
 
+    return unique_ids[id_codes[group_starts]], frames[group_starts], means.astype(np.float32)
 
-def summarise_reconstruction_per_frame(recs, frames):
-    unique_frames = np.unique(frames)
-    unique_recs = np.empty((len(unique_frames), recs.shape[-1]), dtype=np.float32)
-    for idx, frame in enumerate(unique_frames):
-        mask = frames == frame
-        unique_recs[idx, :] = np.mean(recs[mask, :], axis=0, keepdims=True)
 
-    return unique_frames, unique_recs
+def summarise_reconstruction(reconstructed_X, frames, trajectory_ids):
+    input_dim = reconstructed_X.shape[-1]
+    reconstructed_X = reconstructed_X.reshape(-1, input_dim)
+    frames = frames.reshape(-1)
+    trajectory_ids = trajectory_ids.reshape(-1)
+
+    return group_mean_per_frame(trajectory_ids, frames, reconstructed_X)
 
 
 def reconstruct_data(x, video_resolution, reconstruct_original_data, global_scaler, local_scaler, out_scaler):